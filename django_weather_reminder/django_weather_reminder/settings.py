@@ -192,6 +192,33 @@ EMAIL_HOST = os.environ.get('EMAIL_HOST')
 EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD')
 EMAIL_PORT = int(os.environ.get('EMAIL_PORT', '587'))
+EMAIL_TIMEOUT = int(os.environ.get('EMAIL_TIMEOUT', '30'))
+# forecast emails are sent by one SMTP connection in batches of this size
+EMAIL_BATCH_SIZE = int(os.environ.get('EMAIL_BATCH_SIZE', '100'))
+# reconnections to the SMTP server during one sending if the server closes the connection
+EMAIL_RECONNECT_ATTEMPTS = int(os.environ.get('EMAIL_RECONNECT_ATTEMPTS', '3'))
+# forecast emails of the hour are spread across this number of minutes by stable per user offsets,
+# sending ends before the weather forecast update at minute 50
+EMAIL_SEND_WINDOW = int(os.environ.get('EMAIL_SEND_WINDOW', '45'))
+# forecast emails are delivered from the outbox by this number of parallel celery subtasks
+EMAIL_DELIVERY_WORKERS = int(os.environ.get('EMAIL_DELIVERY_WORKERS', '4'))
+# delivery attempts of an outbox email and the first retry delay in seconds, the delay doubles for every next retry
+EMAIL_DELIVERY_MAX_ATTEMPTS = int(os.environ.get('EMAIL_DELIVERY_MAX_ATTEMPTS', '4'))
+EMAIL_DELIVERY_RETRY_DELAY = int(os.environ.get('EMAIL_DELIVERY_RETRY_DELAY', '60'))
+# outbox emails claimed by a delivery are claimed again after this number of seconds if the delivery
+# didn't store the result (the worker was stopped)
+EMAIL_DELIVERY_LEASE = int(os.environ.get('EMAIL_DELIVERY_LEASE', '600'))
+# delivered and failed outbox emails are kept for this number of hours
+EMAIL_OUTBOX_KEEP_HOURS = int(os.environ.get('EMAIL_OUTBOX_KEEP_HOURS', '72'))
+# emails per minute, 0 - no limit; 'memory' - limit per process, 'redis' - limit shared via the celery broker
+EMAIL_RATE_LIMIT = float(os.environ.get('EMAIL_RATE_LIMIT', '0'))
+EMAIL_RATE_LIMIT_BACKEND = os.environ.get('EMAIL_RATE_LIMIT_BACKEND', 'memory')
+
+# Weather alerts
+# fired weather alert rules are not checked again for this number of hours
+WEATHER_ALERT_COOLDOWN = int(os.environ.get('WEATHER_ALERT_COOLDOWN', '12'))
+# number of alert rules evaluated at once by array operations
+WEATHER_ALERT_CHUNK_SIZE = int(os.environ.get('WEATHER_ALERT_CHUNK_SIZE', '100000'))
 
 CRISPY_ALLOWED_TEMPLATE_PACKS = "bootstrap5"
 CRISPY_TEMPLATE_PACK = "bootstrap5"
@@ -218,6 +245,85 @@ SOCIALACCOUNT_PROVIDERS = {
 OPENWEATHER_GEOCODING_URL = 'https://api.openweathermap.org/geo/1.0/'
 OPENWEATHER_FORECAST_URL = 'https://api.openweathermap.org/data/2.5/forecast/'
 
+# Openweather HTTP session options
+# connections kept alive to the openweather host
+OPENWEATHER_POOL_SIZE = int(os.environ.get('OPENWEATHER_POOL_SIZE', '10'))
+# connect and read timeouts, in seconds
+OPENWEATHER_CONNECT_TIMEOUT = float(os.environ.get('OPENWEATHER_CONNECT_TIMEOUT', '5'))
+OPENWEATHER_READ_TIMEOUT = float(os.environ.get('OPENWEATHER_READ_TIMEOUT', '15'))
+# retries on connection errors and 5xx responses, with exponential backoff
+OPENWEATHER_MAX_RETRIES = int(os.environ.get('OPENWEATHER_MAX_RETRIES', '3'))
+OPENWEATHER_RETRY_BACKOFF = float(os.environ.get('OPENWEATHER_RETRY_BACKOFF', '0.5'))
+# maximum wait between retries in seconds, also for the Retry-After response header
+OPENWEATHER_RETRY_MAX_WAIT = float(os.environ.get('OPENWEATHER_RETRY_MAX_WAIT', '10'))
+
+# Openweather calls rate limit
+# calls per minute (0 - no limit) and the maximum burst of calls
+OPENWEATHER_RATE_LIMIT = float(os.environ.get('OPENWEATHER_RATE_LIMIT', '60'))
+OPENWEATHER_RATE_LIMIT_BURST = float(os.environ.get('OPENWEATHER_RATE_LIMIT_BURST', '60'))
+# part of the burst reserved for interactive (user requests) calls
+OPENWEATHER_RATE_LIMIT_RESERVE = float(os.environ.get('OPENWEATHER_RATE_LIMIT_RESERVE', '0.2'))
+# 'memory' - limit per process, 'redis' - limit shared by all processes via the celery broker
+OPENWEATHER_RATE_LIMIT_BACKEND = os.environ.get('OPENWEATHER_RATE_LIMIT_BACKEND', 'memory')
+
+# cities stored in the database within this distance (km) are used for coordinates lookup
+# without the weather service reverse geocoding, 0 - always use the weather service
+NEAREST_CITY_DISTANCE = float(os.environ.get('NEAREST_CITY_DISTANCE', '5'))
+
+# redis server of the celery broker and the shared django cache
+REDIS_URL = f'redis://{os.environ.get("REDIS_CREDENTIALS", default="")}{os.environ.get("REDIS_ADDRESS")}'
+
+# Django caches: 'redis' - shared by all processes, 'memory' - per process, only for development and tests
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'redis')
+if CACHE_BACKEND == 'redis':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': f'{REDIS_URL}/1',
+        },
+        # geocoding results are in the separate database, so clearing them doesn't touch other cached values
+        'geocoding': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': f'{REDIS_URL}/2',
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'default',
+        },
+        'geocoding': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'geocoding',
+        },
+    }
+
+# Geocoding results cache: in-process LRU cache and django cache with the alias,
+# the alias must be used only for geocoding results
+GEOCODING_CACHE_ALIAS = os.environ.get('GEOCODING_CACHE_ALIAS', 'geocoding')
+GEOCODING_CACHE_SIZE = int(os.environ.get('GEOCODING_CACHE_SIZE', '10000'))
+# lifetime of found and not found (empty) results, in seconds
+GEOCODING_CACHE_TTL = int(os.environ.get('GEOCODING_CACHE_TTL', str(7 * 24 * 60 * 60)))
+GEOCODING_CACHE_NEGATIVE_TTL = int(os.environ.get('GEOCODING_CACHE_NEGATIVE_TTL', str(60 * 60)))
+
+# API responses cache of the city weather forecasts with the alias, lifetime in seconds
+FORECAST_CACHE_ALIAS = os.environ.get('FORECAST_CACHE_ALIAS', 'default')
+FORECAST_CACHE_TTL = int(os.environ.get('FORECAST_CACHE_TTL', str(2 * 60 * 60)))
+
+# number of rows batch jobs read from the database at once
+BATCH_CHUNK_SIZE = int(os.environ.get('BATCH_CHUNK_SIZE', '2000'))
+
+# Weather forecast update options
+# number of cities whose forecasts are requested from the weather service simultaneously
+WEATHER_UPDATE_CONCURRENCY = int(os.environ.get('WEATHER_UPDATE_CONCURRENCY', '8'))
+# number of celery subtasks the hourly weather forecast update is split into
+WEATHER_UPDATE_SHARDS = int(os.environ.get('WEATHER_UPDATE_SHARDS', '4'))
+# maximum number of cities (weather service calls) updated per run, 0 - no limit
+WEATHER_UPDATE_BUDGET = int(os.environ.get('WEATHER_UPDATE_BUDGET', '0'))
+# cities without subscribers are updated when their forecast is older than this number of hours, 0 - never
+WEATHER_UPDATE_UNSUBSCRIBED_INTERVAL = int(os.environ.get('WEATHER_UPDATE_UNSUBSCRIBED_INTERVAL', '24'))
+
 # Celery Configuration Options
 CELERY_TIMEZONE = TIME_ZONE
 CELERY_TASK_TRACK_STARTED = True
@@ -226,6 +332,6 @@ CELERY_TASK_TIME_LIMIT = 30 * 60
 CELERY_RESULT_BACKEND = 'django-db'
 CELERY_CACHE_BACKEND = 'django-cache'
 
-CELERY_BROKER_URL = f'redis://{os.environ.get("REDIS_CREDENTIALS", default="")}{os.environ.get("REDIS_ADDRESS")}'
+CELERY_BROKER_URL = REDIS_URL
 
 OPENWEATHER_API_KEY = os.environ.get('OPENWEATHER_API_KEY')
@@ -6,3 +6,6 @@ admin.site.register(models.LastUpdateTime)
 admin.site.register(models.City)
 admin.site.register(models.WeatherForecast)
 admin.site.register(models.Subscription)
+admin.site.register(models.AlertRule)
+admin.site.register(models.NotificationSettings)
+admin.site.register(models.EmailOutbox)
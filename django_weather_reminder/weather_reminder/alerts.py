@@ -0,0 +1,229 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from itertools import groupby, islice
+from operator import attrgetter
+
+import numpy as np
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db.models import Max, Q, QuerySet
+
+from weather_reminder.models import AlertRule, City, WeatherForecast
+from weather_reminder.service import SendStatistics, WeatherForecastSender, iterate_by_keyset
+
+
+# forecast fields and operators in the order of their codes in the evaluation arrays
+alert_fields = AlertRule.Field.values
+alert_operators = AlertRule.Operator.values
+
+
+@dataclass
+class ForecastMatrix:
+    """
+    Weather forecasts of cities as arrays:
+        city_ids: sorted city ids (C)
+        times: sorted forecast times, seconds from the epoch (T)
+        values: values of alert fields (F x C x T), NaN if the city has no forecast for the time
+
+    """
+    city_ids: np.ndarray
+    times: np.ndarray
+    values: np.ndarray
+
+    @classmethod
+    def load(cls, cities: QuerySet[City], start: datetime, end: datetime, chunk_size: int = None) -> 'ForecastMatrix':
+        """
+        Loads forecasts of the cities within the time range, rows are read and placed into arrays in chunks
+        :param cities: cities
+        :param start: range start
+        :param end: range end (excluded)
+        :param chunk_size: number of forecast rows read at once, BATCH_CHUNK_SIZE by default
+        :return: forecast matrix
+
+        """
+        chunk_size = chunk_size or settings.BATCH_CHUNK_SIZE
+        forecasts = WeatherForecast.objects.filter(city__in=cities, datetime__gte=start, datetime__lt=end).order_by()
+        city_ids = np.array(sorted(forecasts.values_list('city', flat=True).distinct()), dtype=np.int64)
+        times = np.array(
+            sorted(moment.timestamp() for moment in forecasts.values_list('datetime', flat=True).distinct()),
+            dtype=np.float64
+        )
+        values = np.full((len(alert_fields), len(city_ids), len(times)), np.nan, dtype=np.float32)
+
+        rows = forecasts.values_list('city', 'datetime', *alert_fields).iterator(chunk_size=chunk_size)
+        while chunk := list(islice(rows, chunk_size)):
+            chunk_city_ids, chunk_times, *chunk_values = zip(*chunk)
+            row_index = np.searchsorted(city_ids, np.array(chunk_city_ids, dtype=np.int64))
+            column_index = np.searchsorted(times, np.array([moment.timestamp() for moment in chunk_times]))
+            values[:, row_index, column_index] = np.array(chunk_values, dtype=np.float32)
+
+        return cls(city_ids=city_ids, times=times, values=values)
+
+    def evaluate(
+            self,
+            city_ids: np.ndarray,
+            fields: np.ndarray,
+            operators: np.ndarray,
+            thresholds: np.ndarray,
+            ends: np.ndarray
+    ) -> np.ndarray:
+        """
+        Evaluates alert rules for all forecast times at once
+        :param city_ids: rule city ids (R)
+        :param fields: rule field codes (R)
+        :param operators: rule operator codes (R)
+        :param thresholds: rule thresholds (R)
+        :param ends: rule time range ends, seconds from the epoch (R)
+        :return: index of the first forecast time the rule fires at, -1 if the rule doesn't fire (R)
+
+        """
+        if not len(self.city_ids) or not len(city_ids):
+            return np.full(len(city_ids), -1)
+
+        rows = np.searchsorted(self.city_ids, city_ids)
+        rows = np.minimum(rows, len(self.city_ids) - 1)
+        found = self.city_ids[rows] == city_ids
+
+        # R x T values of the rule field for the rule city
+        series = self.values[fields, rows]
+        thresholds = thresholds[:, None]
+        operators = operators[:, None]
+        fired = np.select(
+            [
+                operators == alert_operators.index(AlertRule.Operator.GT),
+                operators == alert_operators.index(AlertRule.Operator.GTE),
+                operators == alert_operators.index(AlertRule.Operator.LT),
+                operators == alert_operators.index(AlertRule.Operator.LTE),
+            ],
+            [series > thresholds, series >= thresholds, series < thresholds, series <= thresholds],
+            False
+        )
+        # comparisons with NaN (no forecast) are False
+        fired &= self.times[None, :] < ends[:, None]
+        fired &= found[:, None]
+
+        return np.where(fired.any(axis=1), fired.argmax(axis=1), -1)
+
+
+class WeatherAlertSender:
+    """
+    Evaluates subscription alert rules for the stored weather forecasts and notifies users about fired rules
+
+    """
+    @staticmethod
+    def _get_rules_for_evaluation(now: datetime) -> QuerySet[AlertRule]:
+        """
+        Gets alert rules which didn't fire within WEATHER_ALERT_COOLDOWN hours
+        :param now: evaluation time
+        :return: alert rules
+
+        """
+        return AlertRule.objects.filter(
+            Q(last_fired__isnull=True) | Q(last_fired__lte=now - timedelta(hours=settings.WEATHER_ALERT_COOLDOWN))
+        )
+
+    @staticmethod
+    def get_fired_rules(now: datetime = None) -> dict[int, datetime]:
+        """
+        Evaluates alert rules in chunks of WEATHER_ALERT_CHUNK_SIZE, every chunk is evaluated by array operations
+        :param now: evaluation time, now by default
+        :return: time of the first forecast the rule fires at by the fired rule id
+
+        """
+        now = now or datetime.now(timezone.utc)
+        rules = WeatherAlertSender._get_rules_for_evaluation(now)
+
+        max_hours_ahead = rules.aggregate(hours=Max('hours_ahead'))['hours']
+        if max_hours_ahead is None:
+            return {}
+
+        matrix = ForecastMatrix.load(
+            City.objects.filter(subscribed_users__alert_rules__in=rules),
+            start=now,
+            end=now + timedelta(hours=max_hours_ahead),
+        )
+
+        fired_rules = {}
+        rule_values = rules.values('id', 'subscription__city', 'field', 'operator', 'threshold', 'hours_ahead')
+        for chunk in iterate_by_keyset(rule_values, key='id', chunk_size=settings.WEATHER_ALERT_CHUNK_SIZE):
+            first_fired = matrix.evaluate(
+                city_ids=np.array([rule['subscription__city'] for rule in chunk], dtype=np.int64),
+                fields=np.array([alert_fields.index(rule['field']) for rule in chunk]),
+                operators=np.array([alert_operators.index(rule['operator']) for rule in chunk]),
+                thresholds=np.array([rule['threshold'] for rule in chunk], dtype=np.float32),
+                ends=np.array([(now + timedelta(hours=rule['hours_ahead'])).timestamp() for rule in chunk]),
+            )
+            for index in np.flatnonzero(first_fired >= 0):
+                moment = datetime.fromtimestamp(matrix.times[first_fired[index]], timezone.utc)
+                fired_rules[chunk[index]['id']] = moment
+
+        return fired_rules
+
+    @staticmethod
+    def _create_alert_email(user, rules: list[AlertRule], fired_rules: dict[int, datetime]) -> EmailMessage:
+        """
+        Creates weather alert email for the user
+        :param user: user
+        :param rules: user fired rules with selected related subscriptions and cities
+        :param fired_rules: time of the first forecast the rule fires at by the rule id
+        :return: email message
+
+        """
+        lines = []
+        for rule in rules:
+            city = rule.subscription.city
+            local_time = fired_rules[rule.pk] + timedelta(seconds=city.timezone)
+            lines.append(
+                f'{city}: {rule.get_field_display()} {rule.get_operator_display()} {rule.threshold} '
+                f'at {local_time:%Y-%m-%d %H:%M} (local time)'
+            )
+
+        return EmailMessage(
+            subject='Weather alert.',
+            body='\n'.join(lines),
+            from_email=settings.EMAIL_HOST_USER,
+            to=[user.email],
+        )
+
+    @staticmethod
+    def send_weather_alerts(now: datetime = None) -> SendStatistics:
+        """
+        Evaluates alert rules and sends one email with all fired rules to every user.
+        Rules are marked as fired only if the email is sent
+        :param now: evaluation time, now by default
+        :return: sending counts
+
+        """
+        now = now or datetime.now(timezone.utc)
+        fired_rules = WeatherAlertSender.get_fired_rules(now)
+        statistics = SendStatistics()
+        if not fired_rules:
+            return statistics
+
+        rules = AlertRule.objects.filter(pk__in=fired_rules).select_related('subscription__user', 'subscription__city')\
+            .order_by('subscription__user', 'pk')
+
+        messages = {}
+        with get_connection() as connection:
+            def send_batch() -> None:
+                sent, skipped, failed = WeatherForecastSender.send_messages(connection, list(messages))
+                AlertRule.objects.filter(pk__in=[pk for message in sent for pk in messages[message]])\
+                    .update(last_fired=now)
+                statistics.sent += len(sent)
+                statistics.skipped += len(skipped)
+                statistics.failed += len(failed)
+                messages.clear()
+
+            for _, user_rules in groupby(rules.iterator(), key=attrgetter('subscription.user_id')):
+                user_rules = list(user_rules)
+                user = user_rules[0].subscription.user
+                message = WeatherAlertSender._create_alert_email(user, user_rules, fired_rules)
+                messages[message] = [rule.pk for rule in user_rules]
+
+                if len(messages) >= settings.EMAIL_BATCH_SIZE:
+                    send_batch()
+
+            if messages:
+                send_batch()
+
+        return statistics
@@ -32,6 +32,8 @@ class WeatherReminderConfig(AppConfig):
             )
 
     def ready(self):
+        from weather_reminder import signals  # noqa: F401
+
         if 'migrate' in sys.argv:
             # avoid executing code if it called with "manage.py migrate"
             return
@@ -56,6 +58,15 @@ class WeatherReminderConfig(AppConfig):
             month_of_year='*',
         )
 
+        # execute every minute
+        email_outbox_delivery_schedule, _ = CrontabSchedule.objects.get_or_create(
+            minute='*',
+            hour='*',
+            day_of_week='*',
+            day_of_month='*',
+            month_of_year='*',
+        )
+
         # check necessary tasks existence and create them if they don't exist
         self._check_or_add_task(
             schedule=weather_forecast_update_schedule,
@@ -68,3 +79,9 @@ class WeatherReminderConfig(AppConfig):
             name='Send weather forecast to users',
             task='weather_reminder.tasks.send_weather_forecast'
         )
+
+        self._check_or_add_task(
+            schedule=email_outbox_delivery_schedule,
+            name='Deliver weather forecast emails',
+            task='weather_reminder.tasks.dispatch_email_outbox'
+        )
@@ -0,0 +1,137 @@
+import csv
+import gzip
+import io
+from abc import ABC, abstractmethod
+
+import orjson
+from rest_framework.utils.encoders import JSONEncoder
+
+from weather_reminder.models import City, NotificationSettings
+from weather_reminder.serializers import CitySerializer, WeatherForecastSerializer
+
+
+# DRF representation of the values orjson doesn't serialize the same way (datetimes, generators)
+_encoder = JSONEncoder()
+
+
+def dump_json(data) -> bytes:
+    """
+    Renders data to compact JSON by orjson, the output is the same as of the DRF JSONRenderer
+    :param data: serializer data
+    :return: JSON
+
+    """
+    return orjson.dumps(data, default=_encoder.default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+
+class ForecastAttachment(ABC):
+    """
+    Base class for forecast attachment formats.
+    Every city is rendered to a fragment once, fragments of the user cities are joined to the attachment
+
+    """
+    filename: str
+    mimetype: str
+    # attachments with the same fragment key share rendered fragments
+    fragment_key: str
+
+    @abstractmethod
+    def render_city(self, city: City, forecasts: list[dict]) -> bytes:
+        """
+        Renders the city weather forecast to the fragment
+        :param city: city
+        :param forecasts: city weather forecasts in the WeatherForecastSerializer representation
+        :return: fragment
+
+        """
+        pass
+
+    @abstractmethod
+    def join(self, fragments: list[bytes]) -> bytes:
+        """
+        Joins fragments of the cities to the attachment content
+        :param fragments: rendered cities
+        :return: attachment content
+
+        """
+        pass
+
+
+class JSONAttachment(ForecastAttachment):
+    """
+    List of cities with the list of forecast objects
+    """
+    filename = 'forecast.json'
+    mimetype = 'application/json'
+    fragment_key = 'json'
+
+    def render_city(self, city: City, forecasts: list[dict]) -> bytes:
+        return dump_json({**CitySerializer(city).data, 'forecast': forecasts})
+
+    def join(self, fragments: list[bytes]) -> bytes:
+        return b'[' + b','.join(fragments) + b']'
+
+
+class GzipJSONAttachment(JSONAttachment):
+    """
+    Compressed JSON attachment
+    """
+    filename = 'forecast.json.gz'
+    mimetype = 'application/gzip'
+
+    def join(self, fragments: list[bytes]) -> bytes:
+        # mtime=0 makes the content repeatable
+        return gzip.compress(super().join(fragments), compresslevel=6, mtime=0)
+
+
+class ColumnarJSONAttachment(JSONAttachment):
+    """
+    List of cities with one array of values per forecast field
+    """
+    filename = 'forecast.columnar.json'
+    fragment_key = 'columnar'
+
+    def render_city(self, city: City, forecasts: list[dict]) -> bytes:
+        data = CitySerializer(city).data
+        data['forecast'] = {
+            field: [forecast[field] for forecast in forecasts]
+            for field in WeatherForecastSerializer.Meta.fields
+        }
+        return dump_json(data)
+
+
+class CSVAttachment(ForecastAttachment):
+    """
+    One row per city forecast with city and forecast fields
+    """
+    filename = 'forecast.csv'
+    mimetype = 'text/csv'
+    fragment_key = 'csv'
+    header = CitySerializer.Meta.fields + WeatherForecastSerializer.Meta.fields
+
+    @staticmethod
+    def _render_rows(rows) -> bytes:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        return buffer.getvalue().encode()
+
+    def render_city(self, city: City, forecasts: list[dict]) -> bytes:
+        city_row = list(CitySerializer(city).data.values())
+        return self._render_rows(
+            city_row + [
+                _encoder.default(value) if hasattr(value, 'isoformat') else value
+                for value in forecast.values()
+            ]
+            for forecast in forecasts
+        )
+
+    def join(self, fragments: list[bytes]) -> bytes:
+        return self._render_rows([self.header]) + b''.join(fragments)
+
+
+attachment_formats: dict[str, ForecastAttachment] = {
+    NotificationSettings.AttachmentFormat.JSON: JSONAttachment(),
+    NotificationSettings.AttachmentFormat.JSON_GZIP: GzipJSONAttachment(),
+    NotificationSettings.AttachmentFormat.COLUMNAR_JSON: ColumnarJSONAttachment(),
+    NotificationSettings.AttachmentFormat.CSV: CSVAttachment(),
+}
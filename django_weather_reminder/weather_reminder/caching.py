@@ -0,0 +1,276 @@
+import hashlib
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from functools import cache
+from threading import Lock
+from typing import Literal, Callable, Iterable
+
+from django.conf import settings
+from django.core.cache import caches
+
+from weather_reminder.connector import ServiceConnector, CityData, WeatherForecastData, round_coordinate
+from weather_reminder.models import City, LastUpdateTime
+from weather_reminder.serializers import FastWeatherForecastSerializer
+
+
+# marks a missing cache value, None and empty lists are valid cached values
+missing = object()
+
+
+class TTLCache:
+    """
+    Thread-safe in-process LRU cache with the expiration time for every value
+
+    """
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self._data: OrderedDict[str, tuple[float, object]] = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key: str, default=missing):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+
+            expires, value = item
+            if expires <= time.monotonic():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value, ttl: float) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+@dataclass
+class CacheStatistics:
+    """
+    Geocoding cache counters:
+        memory_hits: values found in the in-process cache
+        shared_hits: values found in the django cache
+        misses: values requested from the weather service
+
+    """
+    memory_hits: int = 0
+    shared_hits: int = 0
+    misses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.memory_hits + self.shared_hits + self.misses
+        return (self.memory_hits + self.shared_hits) / total if total else 0.0
+
+
+class GeocodingCache:
+    """
+    Two-tier cache of the geocoding results: in-process LRU cache and shared django cache.
+    Empty results (city not found) are cached with the separate shorter TTL
+
+    """
+    def __init__(self, size: int, ttl: float, negative_ttl: float, cache_alias: str = 'geocoding') -> None:
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.cache_alias = cache_alias
+        self.memory_cache = TTLCache(size)
+        self.statistics = CacheStatistics()
+        self._statistics_lock = Lock()
+
+    def _count(self, counter: str) -> None:
+        with self._statistics_lock:
+            setattr(self.statistics, counter, getattr(self.statistics, counter) + 1)
+
+    def get_or_fetch(self, key: str, fetch: Callable[[], list[CityData]]) -> list[CityData]:
+        """
+        Get the value from the cache, fetch it and store to the cache if it's missing
+        :param key: cache key
+        :param fetch: function for getting the value from the weather service
+        :return: cached or fetched value
+
+        """
+        value = self.memory_cache.get(key)
+        if value is not missing:
+            self._count('memory_hits')
+            return list(value)
+
+        shared_cache = caches[self.cache_alias]
+        value = shared_cache.get(key, missing)
+        if value is not missing:
+            self._count('shared_hits')
+            # the remaining lifetime of the shared value is unknown, keep it in memory for the shorter TTL
+            self.memory_cache.set(key, value, self.negative_ttl)
+            return list(value)
+
+        self._count('misses')
+        value = fetch()
+        ttl = self.ttl if value else self.negative_ttl
+        shared_cache.set(key, value, ttl)
+        self.memory_cache.set(key, value, ttl)
+        return list(value)
+
+    def clear(self) -> None:
+        """
+        Clear both cache tiers and counters.
+        The whole django cache of the alias is cleared, so the alias must be dedicated to geocoding results
+
+        """
+        self.memory_cache.clear()
+        caches[self.cache_alias].clear()
+        self.statistics = CacheStatistics()
+
+
+@cache
+def get_geocoding_cache() -> GeocodingCache:
+    """
+    Get the geocoding cache configured in the settings, one per process
+    :return: geocoding cache
+
+    """
+    return GeocodingCache(
+        size=settings.GEOCODING_CACHE_SIZE,
+        ttl=settings.GEOCODING_CACHE_TTL,
+        negative_ttl=settings.GEOCODING_CACHE_NEGATIVE_TTL,
+        cache_alias=settings.GEOCODING_CACHE_ALIAS,
+    )
+
+
+class ForecastResponseCache:
+    """
+    Cache of the serialized city weather forecasts for API responses.
+    Keys contain the forecast version (the last update time) and the city forecast update time,
+    so the cached forecasts are replaced after every weather forecast update
+
+    """
+    def __init__(self, ttl: float, cache_alias: str = 'default') -> None:
+        self.ttl = ttl
+        self.cache_alias = cache_alias
+        self.statistics = CacheStatistics()
+        self._statistics_lock = Lock()
+
+    @staticmethod
+    def get_version(updated: datetime | None) -> str:
+        """
+        Get the forecast version, it's changed by every weather forecast update
+        :param updated: last weather forecast update time, None if forecasts were never updated
+        :return: version
+
+        """
+        return str(updated.timestamp()) if updated else '0'
+
+    @staticmethod
+    def get_last_update() -> datetime | None:
+        """
+        Get the last weather forecast update time
+        :return: update time or None if forecasts were never updated
+
+        """
+        return LastUpdateTime.get_updated(LastUpdateTime.Key.FORECAST)
+
+    @staticmethod
+    def _get_key(version: str, city: City) -> str:
+        city_version = city.forecast_updated.timestamp() if city.forecast_updated else 0
+        return f'weather_reminder:forecast:{version}:{city.pk}:{city_version}'
+
+    def get_cities_data(self, cities: Iterable[City], version: str = None) -> list[dict]:
+        """
+        Get serialized weather forecasts of the cities, cities missing in the cache are serialized
+        with all their forecasts loaded by one query and stored to the cache
+        :param cities: cities
+        :param version: forecast version if it's already known
+        :return: serialized cities with forecasts in the order of the cities
+
+        """
+        cities = list(cities)
+        if not cities:
+            return []
+
+        version = version or self.get_version(self.get_last_update())
+        keys = [self._get_key(version, city) for city in cities]
+        cache = caches[self.cache_alias]
+        cached = cache.get_many(keys)
+
+        missed = [city for city, key in zip(cities, keys) if key not in cached]
+        with self._statistics_lock:
+            self.statistics.shared_hits += len(cities) - len(missed)
+            self.statistics.misses += len(missed)
+
+        if missed:
+            serialized = dict(zip(
+                (self._get_key(version, city) for city in missed),
+                FastWeatherForecastSerializer().get_cities_data(missed)
+            ))
+            cache.set_many(serialized, self.ttl)
+            cached.update(serialized)
+
+        return [cached[key] for key in keys]
+
+    def reset_statistics(self) -> None:
+        """
+        Reset counters, cached forecasts are kept, they expire or are replaced with the new version
+
+        """
+        self.statistics = CacheStatistics()
+
+
+@cache
+def get_forecast_response_cache() -> ForecastResponseCache:
+    """
+    Get the forecast response cache configured in the settings, one per process
+    :return: forecast response cache
+
+    """
+    return ForecastResponseCache(
+        ttl=settings.FORECAST_CACHE_TTL,
+        cache_alias=settings.FORECAST_CACHE_ALIAS,
+    )
+
+
+class CachedConnector(ServiceConnector):
+    """
+    Wrapper for a weather service connector, caches parsed geocoding results.
+    Weather forecast calls are not cached
+
+    """
+    service_connector: ServiceConnector
+    geocoding_cache: GeocodingCache
+
+    def __init__(self, service_connector: ServiceConnector, geocoding_cache: GeocodingCache = None) -> None:
+        self.service_connector = service_connector
+        self.geocoding_cache = geocoding_cache or get_geocoding_cache()
+
+    def get_cities_info_by_name(self, city_name: str) -> list[CityData]:
+        name_hash = hashlib.sha256(city_name.strip().lower().encode()).hexdigest()
+        return self.geocoding_cache.get_or_fetch(
+            f'weather_reminder:geocoding:direct:{name_hash}',
+            lambda: self.service_connector.get_cities_info_by_name(city_name)
+        )
+
+    def get_city_info_by_coordinates(self, coordinates: dict[Literal['lat', 'lon'], float]) -> list[CityData]:
+        latitude = round_coordinate(float(coordinates['lat']))
+        longitude = round_coordinate(float(coordinates['lon']))
+        return self.geocoding_cache.get_or_fetch(
+            f'weather_reminder:geocoding:reverse:{latitude}:{longitude}',
+            lambda: self.service_connector.get_city_info_by_coordinates(coordinates)
+        )
+
+    def get_city_weather_forecast(self, city: CityData) -> tuple[list[WeatherForecastData], int]:
+        return self.service_connector.get_city_weather_forecast(city)
+
+    def get_city_weather_forecast_if_changed(
+            self,
+            city: CityData,
+            fingerprint: str
+    ) -> tuple[list[WeatherForecastData] | None, int | None, str]:
+        return self.service_connector.get_city_weather_forecast_if_changed(city, fingerprint)
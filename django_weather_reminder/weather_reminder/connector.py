@@ -1,5 +1,7 @@
+import hashlib
+import json
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from dataclasses import dataclass, asdict
 from datetime import datetime
 from typing import Literal
 
@@ -56,6 +58,17 @@ class WeatherForecastData:
     weather_description: str
 
 
+def forecast_fingerprint(weather_forecast: list[WeatherForecastData]) -> str:
+    """
+    Get a fingerprint of the weather forecast for detecting unchanged forecasts
+    :param weather_forecast: weather forecast
+    :return: sha256 hex digest of the forecast
+
+    """
+    content = json.dumps([asdict(forecast) for forecast in weather_forecast], sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
 class ServiceConnector(ABC):
     """
     Base class for weather services
@@ -98,3 +111,25 @@ class ServiceConnector(ABC):
 
         """
         pass
+
+    def get_city_weather_forecast_if_changed(
+            self,
+            city: CityData,
+            fingerprint: str
+    ) -> tuple[list[WeatherForecastData] | None, int | None, str]:
+        """
+        Get weather forecast for the city if it differs from the previously received one.
+        Service implementations can redefine it to skip parsing of unchanged responses
+        :param city: city
+        :param fingerprint: fingerprint of the previously received forecast
+        :return: weather forecast by time, city timezone and forecast fingerprint,
+                 forecast and timezone are None if the fingerprint is the same
+
+        """
+        weather_forecast, city_timezone = self.get_city_weather_forecast(city)
+        new_fingerprint = forecast_fingerprint(weather_forecast)
+
+        if new_fingerprint == fingerprint:
+            return None, None, fingerprint
+
+        return weather_forecast, city_timezone, new_fingerprint
@@ -0,0 +1,85 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test.utils import override_settings
+
+from weather_reminder.alerts import ForecastMatrix, alert_fields, alert_operators
+from weather_reminder.models import City, WeatherForecast
+
+
+class Command(BaseCommand):
+    help = 'Measures the vectorized evaluation of weather alert rules, generated data is rolled back'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rules',
+            nargs='+',
+            type=int,
+            default=[10000, 100000, 200000],
+            help='Numbers of alert rules to measure with',
+        )
+        parser.add_argument(
+            '--cities',
+            type=int,
+            default=1000,
+            help='Number of cities with forecasts every 3 hours for 5 days',
+        )
+
+    @staticmethod
+    def create_data(cities: int, start: datetime) -> None:
+        """
+        Creates cities with forecasts every 3 hours for 5 days
+        :param cities: number of cities
+        :param start: time of the first forecast
+
+        """
+        city_list = City.objects.bulk_create(
+            City(name=f'Benchmark {i}', country_code='BM', latitude=i / 100, longitude=i / 100, timezone=0)
+            for i in range(cities)
+        )
+        WeatherForecast.objects.bulk_create(
+            (
+                WeatherForecast(
+                    city=city, datetime=start + timedelta(hours=3 * slot), temperature=i % 30 - 15,
+                    temperature_feels_like=i % 30 - 17, pressure=1000 + slot, humidity=50, pop=slot * 2,
+                    cloudiness=slot % 100, wind_speed=i % 20,
+                )
+                for i, city in enumerate(city_list)
+                for slot in range(40)
+            ),
+            batch_size=5000,
+        )
+
+    def handle(self, *args, **options):
+        start = datetime(2022, 1, 1, tzinfo=timezone.utc)
+        generator = np.random.default_rng(0)
+
+        self.stdout.write(f'{"cities":>8}{"rules":>10}{"load, s":>10}{"evaluate, s":>14}{"fired":>10}')
+        # executed queries are kept in memory in the debug mode
+        with override_settings(DEBUG=False), transaction.atomic():
+            self.create_data(options['cities'], start)
+
+            load_start = time.perf_counter()
+            matrix = ForecastMatrix.load(City.objects.all(), start, start + timedelta(hours=120))
+            load_time = time.perf_counter() - load_start
+
+            for rules in sorted(options['rules']):
+                city_ids = generator.choice(matrix.city_ids, rules)
+                fields = generator.integers(0, len(alert_fields), rules)
+                operators = generator.integers(0, len(alert_operators), rules)
+                thresholds = generator.uniform(-20, 100, rules).astype(np.float32)
+                ends = start.timestamp() + generator.integers(1, 121, rules) * 3600.0
+
+                evaluate_start = time.perf_counter()
+                first_fired = matrix.evaluate(city_ids, fields, operators, thresholds, ends)
+                evaluate_time = time.perf_counter() - evaluate_start
+
+                self.stdout.write(
+                    f'{options["cities"]:>8}{rules:>10}{load_time:>10.3f}{evaluate_time:>14.3f}'
+                    f'{int((first_fired >= 0).sum()):>10}'
+                )
+
+            transaction.set_rollback(True)
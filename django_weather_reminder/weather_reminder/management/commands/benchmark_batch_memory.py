@@ -0,0 +1,91 @@
+import resource
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.test.utils import override_settings
+
+from weather_reminder.service import WeatherInterface, WeatherForecastSender
+from weather_reminder.models import Subscription, City
+
+user_model = get_user_model()
+
+
+class Command(BaseCommand):
+    help = 'Measures memory of the batch jobs against the table size, generated data is rolled back'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            nargs='+',
+            type=int,
+            default=[1000, 10000, 50000],
+            help='Numbers of users (subscriptions) to measure with',
+        )
+        parser.add_argument(
+            '--cities',
+            type=int,
+            default=1000,
+            help='Number of cities the users are subscribed to',
+        )
+
+    @staticmethod
+    def create_data(users: int, cities: int) -> None:
+        """
+        Creates cities and users subscribed to them with the hourly notification
+        :param users: number of users
+        :param cities: number of cities
+
+        """
+        city_list = City.objects.bulk_create(
+            City(name=f'Benchmark {i}', country_code='BM', latitude=i / 100, longitude=i / 100, timezone=0)
+            for i in range(cities)
+        )
+        user_list = user_model.objects.bulk_create(
+            (user_model(username=f'benchmark_{i}', email=f'benchmark_{i}@example.com') for i in range(users)),
+            batch_size=5000,
+        )
+        Subscription.objects.bulk_create(
+            (
+                Subscription(city=city_list[i % cities], user=user, notification_frequency=1)
+                for i, user in enumerate(user_list)
+            ),
+            batch_size=5000,
+        )
+
+    @staticmethod
+    def measure(job) -> tuple[float, float]:
+        """
+        Runs the job and measures its memory
+        :param job: function without arguments
+        :return: peak of python allocations during the job and peak RSS of the process, MiB
+
+        """
+        tracemalloc.start()
+        try:
+            job()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        # ru_maxrss is in KiB on Linux
+        return peak / 2**20, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+    def handle(self, *args, **options):
+        jobs = {
+            'cities for update': WeatherInterface.get_city_ids_for_update,
+            # all hourly subscriptions are sent in the first hour
+            'enqueue emails': lambda: WeatherForecastSender.enqueue_weather_forecast(1),
+        }
+
+        self.stdout.write(f'{"job":<20}{"users":>10}{"peak, MiB":>12}{"RSS, MiB":>12}')
+        for size in sorted(options['sizes']):
+            # executed queries are kept in memory in the debug mode
+            with override_settings(DEBUG=False), transaction.atomic():
+                self.create_data(size, options['cities'])
+                for name, job in jobs.items():
+                    peak, rss = self.measure(job)
+                    self.stdout.write(f'{name:<20}{size:>10}{peak:>12.1f}{rss:>12.1f}')
+
+                transaction.set_rollback(True)
@@ -0,0 +1,104 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test.utils import override_settings
+
+from weather_reminder.models import City, WeatherForecast
+from weather_reminder.serializers import CityWeatherForecast, FastWeatherForecastSerializer
+
+
+class Command(BaseCommand):
+    help = 'Compares the forecast serializer with its fast path for a city list, generated data is rolled back'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--cities',
+            nargs='+',
+            type=int,
+            default=[10, 100, 1000],
+            help='Numbers of cities to measure with',
+        )
+        parser.add_argument(
+            '--forecasts',
+            type=int,
+            default=40,
+            help='Number of forecasts per city',
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=3,
+            help='Number of runs, the best time is reported',
+        )
+
+    @staticmethod
+    def create_data(cities: int, forecasts: int) -> list[City]:
+        """
+        Creates cities with forecasts every 3 hours
+        :param cities: number of cities
+        :param forecasts: number of forecasts per city
+        :return: cities
+
+        """
+        start = datetime(2022, 1, 1, tzinfo=timezone.utc)
+        city_list = City.objects.bulk_create(
+            City(name=f'Benchmark {i}', country_code='BM', latitude=i / 100, longitude=i / 100, timezone=i % 24 * 3600)
+            for i in range(cities)
+        )
+        WeatherForecast.objects.bulk_create(
+            (
+                WeatherForecast(
+                    city=city, datetime=start + timedelta(hours=3 * slot), temperature=slot % 30 - 15.5,
+                    temperature_feels_like=slot % 30 - 17.5, pressure=1000 + slot, humidity=50, pop=slot % 100,
+                    cloudiness=slot % 100, wind_speed=slot % 20 + 0.5, weather_description='Benchmark',
+                )
+                for city in city_list
+                for slot in range(forecasts)
+            ),
+            batch_size=5000,
+        )
+        return city_list
+
+    @staticmethod
+    def serialize(cities: list[City]) -> list[dict]:
+        # serializer instances per forecast, forecasts are prefetched again for every run
+        cities = list(City.objects.filter(pk__in=[city.pk for city in cities]).prefetch_related('weather_forecasts'))
+        return [CityWeatherForecast(city).data for city in cities]
+
+    @staticmethod
+    def serialize_fast(cities: list[City]) -> list[dict]:
+        return FastWeatherForecastSerializer().get_cities_data(cities)
+
+    @staticmethod
+    def measure(job, cities: list[City], repeat: int) -> float:
+        """
+        Runs the job several times
+        :param job: serialization function
+        :param cities: cities
+        :param repeat: number of runs
+        :return: best time, seconds
+
+        """
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            job(cities)
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'{"cities":>8}{"forecasts":>12}{"serializer, s":>16}{"fast path, s":>16}{"speedup":>10}')
+        for size in sorted(options['cities']):
+            # executed queries are kept in memory in the debug mode
+            with override_settings(DEBUG=False), transaction.atomic():
+                cities = self.create_data(size, options['forecasts'])
+                serializer_time = self.measure(self.serialize, cities, options['repeat'])
+                fast_time = self.measure(self.serialize_fast, cities, options['repeat'])
+                self.stdout.write(
+                    f'{size:>8}{size * options["forecasts"]:>12}{serializer_time:>16.3f}{fast_time:>16.3f}'
+                    f'{serializer_time / fast_time:>9.1f}x'
+                )
+
+                transaction.set_rollback(True)
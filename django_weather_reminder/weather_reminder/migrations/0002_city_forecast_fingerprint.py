@@ -0,0 +1,18 @@
+# Generated by Django 4.1.4 on 2026-10-18 04:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weather_reminder', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='city',
+            name='forecast_fingerprint',
+            field=models.CharField(blank=True, default='', help_text='Fingerprint of the last stored weather forecast', max_length=64, verbose_name='Forecast fingerprint'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.4 on 2026-10-18 04:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weather_reminder', '0002_city_forecast_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='city',
+            name='forecast_updated',
+            field=models.DateTimeField(blank=True, help_text='Time of the last weather forecast update from the weather service', null=True, verbose_name='Forecast update time'),
+        ),
+    ]
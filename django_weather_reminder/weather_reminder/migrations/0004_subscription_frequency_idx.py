@@ -0,0 +1,17 @@
+# Generated by Django 4.1.4 on 2026-10-18 04:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weather_reminder', '0003_city_forecast_updated'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='subscription',
+            index=models.Index(fields=['notification_frequency'], name='subscription_frequency_idx'),
+        ),
+    ]
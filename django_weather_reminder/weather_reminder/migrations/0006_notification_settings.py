@@ -0,0 +1,27 @@
+# Generated by Django 4.1.4 on 2026-10-18 04:45
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('weather_reminder', '0005_email_outbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationSettings',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('attachment_format', models.CharField(choices=[('json', 'JSON'), ('json.gz', 'Compressed JSON'), ('columnar', 'Columnar JSON'), ('csv', 'CSV')], default='json', help_text='Format of the weather forecast attached to emails', max_length=8, verbose_name='Attachment format')),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='notification_settings', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'Notification settings',
+            },
+        ),
+    ]
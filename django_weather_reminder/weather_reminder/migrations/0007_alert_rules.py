@@ -0,0 +1,32 @@
+# Generated by Django 4.1.4 on 2026-10-18 04:55
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weather_reminder', '0006_notification_settings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscription',
+            name='alerts_only',
+            field=models.BooleanField(default=False, help_text='Send only weather alerts instead of the forecast with the notification frequency', verbose_name='Alerts only'),
+        ),
+        migrations.CreateModel(
+            name='AlertRule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field', models.CharField(choices=[('temperature', 'Temperature'), ('temperature_feels_like', 'Temperature feels like'), ('pressure', 'Atmospheric pressure'), ('humidity', 'Humidity'), ('pop', 'Probability of precipitation'), ('cloudiness', 'Cloudiness'), ('wind_speed', 'Wind speed')], max_length=22, verbose_name='Forecast field')),
+                ('operator', models.CharField(choices=[('gt', '>'), ('gte', '>='), ('lt', '<'), ('lte', '<=')], max_length=3, verbose_name='Comparison operator')),
+                ('threshold', models.DecimalField(decimal_places=1, max_digits=6, verbose_name='Threshold')),
+                ('hours_ahead', models.PositiveSmallIntegerField(default=24, help_text='The rule is checked for the forecast within this number of hours', validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(120)], verbose_name='Hours ahead')),
+                ('last_fired', models.DateTimeField(blank=True, null=True, verbose_name='Last alert time')),
+                ('subscription', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='alert_rules', to='weather_reminder.subscription')),
+            ],
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.1.4 on 2026-10-18 05:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weather_reminder', '0007_alert_rules'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='city',
+            index=models.Index(fields=['name', 'id'], name='city_name_id_idx'),
+        ),
+    ]
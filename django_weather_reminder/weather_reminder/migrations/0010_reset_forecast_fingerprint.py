@@ -0,0 +1,19 @@
+from django.db import migrations
+
+
+def reset_forecast_fingerprint(apps, schema_editor):
+    # stored probabilities of precipitation were truncated to 0 or 1,
+    # the next update rewrites them in percent
+    City = apps.get_model('weather_reminder', 'City')
+    City.objects.update(forecast_fingerprint='')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weather_reminder', '0009_email_outbox_sending'),
+    ]
+
+    operations = [
+        migrations.RunPython(reset_forecast_fingerprint, migrations.RunPython.noop),
+    ]
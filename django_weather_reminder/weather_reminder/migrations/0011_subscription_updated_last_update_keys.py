@@ -0,0 +1,23 @@
+# Generated by Django 4.1.4 on 2026-10-18 05:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weather_reminder', '0010_reset_forecast_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscription',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, verbose_name='Update time'),
+        ),
+        migrations.AlterField(
+            model_name='lastupdatetime',
+            name='key',
+            field=models.CharField(choices=[('-', 'Weather forecast'), ('c', 'Cities'), ('s', 'Subscription deletion')], default='-', max_length=1, primary_key=True, serialize=False),
+        ),
+    ]
@@ -1,20 +1,29 @@
-from datetime import timedelta
+from datetime import datetime, timedelta
 
+from django.core.validators import MinValueValidator, MaxValueValidator
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
 
 from weather_reminder.connector import CityData
 
 
 class LastUpdateTime(models.Model):
     """
-    One-row table for storing specific Openweather last update time
+    Last update times, one row per key: Openweather forecasts, cities and deleted subscriptions
 
     """
+    class Key(models.TextChoices):
+        FORECAST = '-', 'Weather forecast'
+        CITIES = 'c', 'Cities'
+        # subscriptions have their own update time, deletions leave no rows
+        SUBSCRIPTION_DELETION = 's', 'Subscription deletion'
+
     key = models.CharField(
         max_length=1,
         primary_key=True,
-        default='-'
+        choices=Key.choices,
+        default=Key.FORECAST,
     )
     updated = models.DateTimeField(
         auto_now=True,
@@ -25,7 +34,26 @@ class LastUpdateTime(models.Model):
         verbose_name_plural = 'Last update time'
 
     def __str__(self):
-        return str(self.updated)
+        return f'{self.get_key_display()} - {self.updated}'
+
+    @classmethod
+    def get_updated(cls, key: Key) -> datetime | None:
+        """
+        Get the last update time of the key
+        :param key: key
+        :return: update time or None if it was never updated
+
+        """
+        return cls.objects.filter(key=key).values_list('updated', flat=True).first()
+
+    @classmethod
+    def mark_updated(cls, key: Key) -> None:
+        """
+        Stores the current time as the last update time of the key
+        :param key: key
+
+        """
+        cls.objects.update_or_create(key=key)
 
 
 class City(models.Model):
@@ -58,6 +86,19 @@ class City(models.Model):
         verbose_name='Timezone shift',
         help_text='Shift in seconds from UTC',
     )
+    forecast_fingerprint = models.CharField(
+        max_length=64,
+        blank=True,
+        default='',
+        verbose_name='Forecast fingerprint',
+        help_text='Fingerprint of the last stored weather forecast',
+    )
+    forecast_updated = models.DateTimeField(
+        null=True,
+        blank=True,
+        verbose_name='Forecast update time',
+        help_text='Time of the last weather forecast update from the weather service',
+    )
 
     class Meta:
         ordering = ['name']
@@ -65,6 +106,10 @@ class City(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['latitude', 'longitude'], name='unique_coordinates'),
         ]
+        indexes = [
+            # keyset pagination of the city list
+            models.Index(fields=['name', 'id'], name='city_name_id_idx'),
+        ]
 
     def toCityData(self) -> CityData:
         """
@@ -181,11 +226,172 @@ class Subscription(models.Model):
         verbose_name='Notification frequency',
         help_text='Notification frequency, in hours',
     )
+    alerts_only = models.BooleanField(
+        default=False,
+        verbose_name='Alerts only',
+        help_text='Send only weather alerts instead of the forecast with the notification frequency',
+    )
+    updated = models.DateTimeField(
+        auto_now=True,
+        verbose_name='Update time',
+    )
 
     class Meta:
         constraints = [
             models.UniqueConstraint(fields=['user', 'city'], name='unique_subscribe'),
         ]
+        indexes = [
+            models.Index(fields=['notification_frequency'], name='subscription_frequency_idx'),
+        ]
 
     def __str__(self):
         return f'{self.user}, {self.city} - every {self.notification_frequency} hour(s)'
+
+
+class AlertRule(models.Model):
+    """
+    Subscription rule for the weather alert: the forecast field value compared with the threshold
+    within the next hours
+
+    """
+    class Field(models.TextChoices):
+        TEMPERATURE = 'temperature', 'Temperature'
+        TEMPERATURE_FEELS_LIKE = 'temperature_feels_like', 'Temperature feels like'
+        PRESSURE = 'pressure', 'Atmospheric pressure'
+        HUMIDITY = 'humidity', 'Humidity'
+        POP = 'pop', 'Probability of precipitation'
+        CLOUDINESS = 'cloudiness', 'Cloudiness'
+        WIND_SPEED = 'wind_speed', 'Wind speed'
+
+    class Operator(models.TextChoices):
+        GT = 'gt', '>'
+        GTE = 'gte', '>='
+        LT = 'lt', '<'
+        LTE = 'lte', '<='
+
+    subscription = models.ForeignKey(
+        'Subscription',
+        on_delete=models.CASCADE,
+        related_name='alert_rules',
+    )
+    field = models.CharField(
+        max_length=22,
+        choices=Field.choices,
+        verbose_name='Forecast field',
+    )
+    operator = models.CharField(
+        max_length=3,
+        choices=Operator.choices,
+        verbose_name='Comparison operator',
+    )
+    threshold = models.DecimalField(
+        max_digits=6,
+        decimal_places=1,
+        verbose_name='Threshold',
+    )
+    hours_ahead = models.PositiveSmallIntegerField(
+        default=24,
+        validators=[MinValueValidator(1), MaxValueValidator(120)],
+        verbose_name='Hours ahead',
+        help_text='The rule is checked for the forecast within this number of hours',
+    )
+    last_fired = models.DateTimeField(
+        null=True,
+        blank=True,
+        verbose_name='Last alert time',
+    )
+
+    def __str__(self):
+        return f'{self.subscription.city}: {self.field} {self.get_operator_display()} {self.threshold} ' \
+               f'within {self.hours_ahead} hour(s)'
+
+
+class NotificationSettings(models.Model):
+    """
+    User preferences for forecast emails
+
+    """
+    class AttachmentFormat(models.TextChoices):
+        JSON = 'json', 'JSON'
+        JSON_GZIP = 'json.gz', 'Compressed JSON'
+        COLUMNAR_JSON = 'columnar', 'Columnar JSON'
+        CSV = 'csv', 'CSV'
+
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='notification_settings',
+    )
+    attachment_format = models.CharField(
+        max_length=8,
+        choices=AttachmentFormat.choices,
+        default=AttachmentFormat.JSON,
+        verbose_name='Attachment format',
+        help_text='Format of the weather forecast attached to emails',
+    )
+
+    class Meta:
+        verbose_name_plural = 'Notification settings'
+
+    def __str__(self):
+        return f'{self.user} - {self.attachment_format}'
+
+
+class EmailOutbox(models.Model):
+    """
+    Weather forecast emails for delivering, one per user and notification hour
+
+    """
+    class Status(models.TextChoices):
+        PENDING = 'pending', 'Pending'
+        # claimed by a delivery until next_attempt (the lease end)
+        SENDING = 'sending', 'Sending'
+        SENT = 'sent', 'Sent'
+        SKIPPED = 'skipped', 'Skipped'
+        FAILED = 'failed', 'Failed'
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='forecast_emails',
+    )
+    slot = models.PositiveIntegerField(
+        verbose_name='Notification hour',
+        help_text='Number of hours from 2022.01.01',
+    )
+    status = models.CharField(
+        max_length=7,
+        choices=Status.choices,
+        default=Status.PENDING,
+        verbose_name='Status',
+    )
+    attempts = models.PositiveSmallIntegerField(
+        default=0,
+        verbose_name='Delivery attempts',
+    )
+    next_attempt = models.DateTimeField(
+        default=timezone.now,
+        verbose_name='Next delivery attempt time',
+    )
+    sent = models.DateTimeField(
+        null=True,
+        blank=True,
+        verbose_name='Sending time',
+    )
+    error = models.CharField(
+        max_length=250,
+        blank=True,
+        verbose_name='Last delivery error',
+    )
+
+    class Meta:
+        verbose_name_plural = 'Email outbox'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'slot'], name='unique_outbox_email'),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'next_attempt'], name='outbox_delivery_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.user}, hour {self.slot} - {self.status}'
@@ -1,11 +1,30 @@
+import hashlib
+import json
 from datetime import datetime, timezone
+from threading import Lock
 from typing import Literal
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from django.conf import settings
 
 from weather_reminder.connector import CityData, WeatherForecastData, ServiceConnector
 
 
+class CappedRetry(Retry):
+    """
+    Retry which waits at most OPENWEATHER_RETRY_MAX_WAIT seconds between attempts,
+    also if the server asks for a longer wait by the Retry-After header
+
+    """
+    def get_backoff_time(self) -> float:
+        return min(super().get_backoff_time(), settings.OPENWEATHER_RETRY_MAX_WAIT)
+
+    def get_retry_after(self, response) -> float | None:
+        retry_after = super().get_retry_after(response)
+        return None if retry_after is None else min(retry_after, settings.OPENWEATHER_RETRY_MAX_WAIT)
+
+
 class OpenWeatherConnector(ServiceConnector):
     """
     Interface for openweather.org
@@ -14,9 +33,84 @@ class OpenWeatherConnector(ServiceConnector):
     """
     api_key = None
 
+    # keep-alive HTTP session shared by all connector instances in the process
+    _session: requests.Session = None
+    _session_lock = Lock()
+
     def __init__(self) -> None:
         self.api_key = settings.OPENWEATHER_API_KEY
 
+    @staticmethod
+    def _create_session() -> requests.Session:
+        """
+        Create HTTP session with the connection pool and retries on 5xx responses.
+        429 responses are not retried, calls are throttled by the rate limiter which takes one token per call
+        :return: HTTP session
+
+        """
+        retry = CappedRetry(
+            total=settings.OPENWEATHER_MAX_RETRIES,
+            backoff_factor=settings.OPENWEATHER_RETRY_BACKOFF,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset(['GET']),
+            respect_retry_after_header=True,
+            # the last response is checked by raise_for_status
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=settings.OPENWEATHER_POOL_SIZE,
+            pool_maxsize=settings.OPENWEATHER_POOL_SIZE,
+            max_retries=retry,
+        )
+
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    @classmethod
+    def get_session(cls) -> requests.Session:
+        """
+        Get the shared HTTP session, create it on the first call
+        :return: HTTP session
+
+        """
+        if cls._session is None:
+            with cls._session_lock:
+                if cls._session is None:
+                    cls._session = cls._create_session()
+
+        return cls._session
+
+    @classmethod
+    def pool_statistics(cls) -> dict[str, dict[str, int]]:
+        """
+        Get statistics of the shared session connection pools
+        :return: statistics by host: number of opened connections, number of requests made,
+                 number of idle connections in the pool
+
+        """
+        if cls._session is None:
+            return {}
+
+        result = {}
+        for adapter in set(cls._session.adapters.values()):
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools[key]
+                result[f'{pool.scheme}://{pool.host}:{pool.port}'] = {
+                    'connections': pool.num_connections,
+                    'requests': pool.num_requests,
+                    # the pool queue is pre-filled with None placeholders
+                    'idle': sum(1 for connection in list(pool.pool.queue) if connection is not None)
+                    if pool.pool is not None else 0,
+                }
+
+        return result
+
+    @staticmethod
+    def _get_timeout() -> tuple[float, float]:
+        return settings.OPENWEATHER_CONNECT_TIMEOUT, settings.OPENWEATHER_READ_TIMEOUT
+
     @staticmethod
     def _parse_geocoding_response(geeodata: list[dict] | dict) -> list[CityData]:
         """
@@ -66,7 +160,8 @@ class OpenWeatherConnector(ServiceConnector):
                 temperature_feels_like=float(moment['main']['feels_like']),
                 pressure=int(moment['main']['pressure']),
                 humidity=int(moment['main']['humidity']),
-                pop=int(moment['pop']),
+                # probability of precipitation comes as a fraction, stored in percent
+                pop=round(float(moment['pop']) * 100),
                 cloudiness=int(moment['clouds']['all']),
                 wind_speed=float(moment['wind']['speed']),
                 weather_description='; '.join(weather_description_list),
@@ -74,6 +169,20 @@ class OpenWeatherConnector(ServiceConnector):
         city_timezone = int(weather_data['city']['timezone'])
         return result, city_timezone
 
+    @staticmethod
+    def _weather_forecast_response_fingerprint(weather_data: dict) -> str:
+        """
+        Get a fingerprint of the forecast part of the weather forecast response
+        :param weather_data: weather forecast response
+        :return: sha256 hex digest of the forecast list and city timezone
+
+        """
+        content = json.dumps(
+            [weather_data.get('list'), weather_data.get('city', {}).get('timezone')],
+            sort_keys=True
+        )
+        return hashlib.sha256(content.encode()).hexdigest()
+
     def _make_geocoding_request(
             self,
             api_method: str,
@@ -91,7 +200,11 @@ class OpenWeatherConnector(ServiceConnector):
         params = parameters.copy() if api_method == 'reverse' else {'q': parameters, 'limit': 5}
         params['appid'] = self.api_key
 
-        res = requests.get(f'{settings.OPENWEATHER_GEOCODING_URL}{api_method}', params=params)
+        res = self.get_session().get(
+            f'{settings.OPENWEATHER_GEOCODING_URL}{api_method}',
+            params=params,
+            timeout=self._get_timeout()
+        )
         res.raise_for_status()
         return res.json()
 
@@ -112,7 +225,11 @@ class OpenWeatherConnector(ServiceConnector):
             'appid': self.api_key,
         }
 
-        res = requests.get(f'{settings.OPENWEATHER_FORECAST_URL}', params=params)
+        res = self.get_session().get(
+            f'{settings.OPENWEATHER_FORECAST_URL}',
+            params=params,
+            timeout=self._get_timeout()
+        )
         res.raise_for_status()
         return res.json()
 
@@ -146,3 +263,26 @@ class OpenWeatherConnector(ServiceConnector):
 
         """
         return self._parse_weather_forecast_response(self._make_weather_forecast_request(city))
+
+    def get_city_weather_forecast_if_changed(
+            self,
+            city: CityData,
+            fingerprint: str
+    ) -> tuple[list[WeatherForecastData] | None, int | None, str]:
+        """
+        Get a weather forecast for the city if the openweather response differs from the previously received one,
+        unchanged responses are not parsed
+        :param city: city info
+        :param fingerprint: fingerprint of the previously received response
+        :return: list with weather forecast by time, city timezone and response fingerprint,
+                 forecast and timezone are None if the fingerprint is the same
+
+        """
+        weather_data = self._make_weather_forecast_request(city)
+        new_fingerprint = self._weather_forecast_response_fingerprint(weather_data)
+
+        if new_fingerprint == fingerprint:
+            return None, None, fingerprint
+
+        weather_forecast, city_timezone = self._parse_weather_forecast_response(weather_data)
+        return weather_forecast, city_timezone, new_fingerprint
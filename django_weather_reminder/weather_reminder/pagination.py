@@ -0,0 +1,11 @@
+from rest_framework.pagination import CursorPagination
+
+
+class CityCursorPagination(CursorPagination):
+    """
+    Keyset pagination of cities by name, the next page is read from the (name, id) index
+    after the last city name of the page, so deep pages cost the same as the first one.
+    Cities with the same name are ordered by id
+
+    """
+    ordering = ('name', 'id')
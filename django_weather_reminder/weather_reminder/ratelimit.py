@@ -0,0 +1,223 @@
+import time
+from abc import ABC, abstractmethod
+from functools import cache
+from threading import Lock
+from typing import Literal
+
+from django.conf import settings
+
+from weather_reminder.connector import ServiceConnector, CityData, WeatherForecastData
+
+
+Priority = Literal['interactive', 'bulk']
+
+INTERACTIVE: Priority = 'interactive'
+BULK: Priority = 'bulk'
+
+
+class TokenBucket(ABC):
+    """
+    Base class for token bucket rate limiters.
+    The bucket holds up to capacity tokens and is refilled with rate tokens per second,
+    every weather service call takes one token.
+    A part of the bucket (reserve) is available only for interactive calls,
+    so bulk calls slow down before interactive calls have to wait.
+
+    """
+    rate: float
+    capacity: float
+    reserve: float
+
+    def __init__(self, rate: float, capacity: float, reserve: float = 0) -> None:
+        if rate <= 0:
+            raise ValueError(f'Token bucket rate must be positive, got {rate}')
+
+        self.rate = rate
+        self.capacity = capacity
+        self.reserve = min(reserve, capacity - 1)
+
+    @abstractmethod
+    def _try_acquire(self, tokens: float, floor: float) -> float:
+        """
+        Take tokens from the bucket if at least floor tokens remain in the bucket after that
+        :param tokens: number of tokens to take
+        :param floor: number of tokens which must remain in the bucket
+        :return: 0 if tokens were taken, otherwise time in seconds until enough tokens are in the bucket
+
+        """
+        pass
+
+    def acquire(self, priority: Priority = INTERACTIVE, tokens: float = 1) -> None:
+        """
+        Take tokens from the bucket, wait until the bucket has enough tokens
+        :param priority: interactive calls can take reserved tokens, bulk calls can't
+        :param tokens: number of tokens to take
+
+        """
+        floor = 0 if priority == INTERACTIVE else self.reserve
+        while (wait := self._try_acquire(tokens, floor)) > 0:
+            time.sleep(wait)
+
+
+class MemoryTokenBucket(TokenBucket):
+    """
+    Token bucket shared by the threads of one process
+
+    """
+    def __init__(self, rate: float, capacity: float, reserve: float = 0) -> None:
+        super().__init__(rate, capacity, reserve)
+        self._tokens = float(capacity)
+        self._timestamp = time.monotonic()
+        self._lock = Lock()
+
+    def _try_acquire(self, tokens: float, floor: float) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._timestamp) * self.rate)
+            self._timestamp = now
+
+            if self._tokens - tokens >= floor:
+                self._tokens -= tokens
+                return 0
+
+            return (tokens + floor - self._tokens) / self.rate
+
+
+class RedisTokenBucket(TokenBucket):
+    """
+    Token bucket shared by all processes using the same redis server (celery broker)
+
+    """
+    # refill and take tokens atomically, redis server time is used for all clients
+    script = """
+        local rate = tonumber(ARGV[1])
+        local capacity = tonumber(ARGV[2])
+        local tokens = tonumber(ARGV[3])
+        local floor = tonumber(ARGV[4])
+        local time = redis.call('TIME')
+        local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'timestamp')
+        local available = tonumber(bucket[1]) or capacity
+        local timestamp = tonumber(bucket[2]) or now
+        available = math.min(capacity, available + math.max(0, now - timestamp) * rate)
+
+        local wait = 0
+        if available - tokens >= floor then
+            available = available - tokens
+        else
+            wait = (tokens + floor - available) / rate
+        end
+
+        redis.call('HSET', KEYS[1], 'tokens', tostring(available), 'timestamp', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+        return tostring(wait)
+    """
+
+    def __init__(self, rate: float, capacity: float, reserve: float = 0, url: str = None,
+                 key: str = 'weather_reminder:rate_limit') -> None:
+        import redis
+
+        super().__init__(rate, capacity, reserve)
+        self.key = key
+        self._script = redis.Redis.from_url(url or settings.CELERY_BROKER_URL).register_script(self.script)
+
+    def _try_acquire(self, tokens: float, floor: float) -> float:
+        return float(self._script(keys=[self.key], args=[self.rate, self.capacity, tokens, floor]))
+
+
+def create_token_bucket(backend: Literal['memory', 'redis'], **kwargs) -> TokenBucket:
+    """
+    Create the token bucket with the backend
+    :param backend: 'memory' - limit per process, 'redis' - limit shared by all processes via the celery broker
+    :param kwargs: token bucket parameters
+    :return: token bucket
+
+    """
+    backends = {
+        'memory': MemoryTokenBucket,
+        'redis': RedisTokenBucket,
+    }
+
+    if backend == 'memory':
+        kwargs.pop('key', None)
+
+    return backends[backend](**kwargs)
+
+
+@cache
+def get_rate_limiter() -> TokenBucket | None:
+    """
+    Get the weather service rate limiter configured in the settings, one per process
+    :return: token bucket or None if calls are not limited
+
+    """
+    if settings.OPENWEATHER_RATE_LIMIT <= 0:
+        return None
+
+    return create_token_bucket(
+        settings.OPENWEATHER_RATE_LIMIT_BACKEND,
+        rate=settings.OPENWEATHER_RATE_LIMIT / 60,
+        capacity=settings.OPENWEATHER_RATE_LIMIT_BURST,
+        reserve=settings.OPENWEATHER_RATE_LIMIT_BURST * settings.OPENWEATHER_RATE_LIMIT_RESERVE,
+    )
+
+
+@cache
+def get_email_rate_limiter() -> TokenBucket | None:
+    """
+    Get the email sending rate limiter configured in the settings, one per process
+    :return: token bucket or None if sending is not limited
+
+    """
+    if not settings.EMAIL_RATE_LIMIT:
+        return None
+
+    return create_token_bucket(
+        settings.EMAIL_RATE_LIMIT_BACKEND,
+        rate=settings.EMAIL_RATE_LIMIT / 60,
+        capacity=max(settings.EMAIL_RATE_LIMIT / 60, 1),
+        key='weather_reminder:email_rate_limit',
+    )
+
+
+class RateLimitedConnector(ServiceConnector):
+    """
+    Wrapper for a weather service connector, takes a rate limiter token before every service call.
+    Geocoding calls are always interactive, weather forecast calls have the connector priority
+
+    """
+    service_connector: ServiceConnector
+    rate_limiter: TokenBucket | None
+    priority: Priority
+
+    def __init__(self, service_connector: ServiceConnector, rate_limiter: TokenBucket = None,
+                 priority: Priority = INTERACTIVE) -> None:
+        self.service_connector = service_connector
+        self.rate_limiter = rate_limiter or get_rate_limiter()
+        self.priority = priority
+
+    def _acquire(self, priority: Priority) -> None:
+        # calls are not limited if the rate limit is not configured
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(priority)
+
+    def get_cities_info_by_name(self, city_name: str) -> list[CityData]:
+        self._acquire(INTERACTIVE)
+        return self.service_connector.get_cities_info_by_name(city_name)
+
+    def get_city_info_by_coordinates(self, coordinates: dict[Literal['lat', 'lon'], float]) -> list[CityData]:
+        self._acquire(INTERACTIVE)
+        return self.service_connector.get_city_info_by_coordinates(coordinates)
+
+    def get_city_weather_forecast(self, city: CityData) -> tuple[list[WeatherForecastData], int]:
+        self._acquire(self.priority)
+        return self.service_connector.get_city_weather_forecast(city)
+
+    def get_city_weather_forecast_if_changed(
+            self,
+            city: CityData,
+            fingerprint: str
+    ) -> tuple[list[WeatherForecastData] | None, int | None, str]:
+        self._acquire(self.priority)
+        return self.service_connector.get_city_weather_forecast_if_changed(city, fingerprint)
@@ -1,4 +1,10 @@
+from collections.abc import Iterable
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.utils import timezone
 from rest_framework import serializers
+from rest_framework.settings import api_settings
 
 from weather_reminder import models
 
@@ -35,6 +41,7 @@ class SubscriptionListSerializer(serializers.ModelSerializer):
             'latitude',
             'longitude',
             'notification_frequency',
+            'alerts_only',
         )
 
 
@@ -51,6 +58,40 @@ class SubscriptionSerializer(serializers.ModelSerializer):
         fields = (
             'city',
             'notification_frequency',
+            'alerts_only',
+        )
+
+
+class AlertRuleSerializer(serializers.ModelSerializer):
+    """
+    Serializer for subscription alert rules creating, retrieving, updating and destroying
+
+    """
+    class Meta:
+        model = models.AlertRule
+        fields = (
+            'id',
+            'field',
+            'operator',
+            'threshold',
+            'hours_ahead',
+            'last_fired',
+        )
+        read_only_fields = (
+            'id',
+            'last_fired',
+        )
+
+
+class NotificationSettingsSerializer(serializers.ModelSerializer):
+    """
+    Serializer for user notification settings retrieving and updating
+
+    """
+    class Meta:
+        model = models.NotificationSettings
+        fields = (
+            'attachment_format',
         )
 
 
@@ -75,6 +116,36 @@ class WeatherForecastSerializer(serializers.ModelSerializer):
         )
 
 
+class ForecastWindowSerializer(serializers.Serializer):
+    """
+    Serializer for the forecast time window query parameters:
+    from - first forecast time, to - forecast time range end (excluded),
+    hours_ahead - window length from 'from' or from the start of the current hour
+
+    """
+    hours_ahead = serializers.IntegerField(min_value=1, max_value=120, required=False)
+
+    def get_fields(self):
+        fields = super().get_fields()
+        # 'from' is a python keyword
+        fields['from'] = serializers.DateTimeField(required=False)
+        fields['to'] = serializers.DateTimeField(required=False)
+        return fields
+
+    def validate(self, attrs):
+        start, end, current_hour = attrs.get('from'), attrs.get('to'), None
+        if 'hours_ahead' in attrs:
+            if start is None:
+                current_hour = start = timezone.now().replace(minute=0, second=0, microsecond=0)
+            window_end = start + timedelta(hours=attrs['hours_ahead'])
+            end = min(end, window_end) if end else window_end
+
+        if start and end and start >= end:
+            raise serializers.ValidationError('The forecast window is empty.')
+
+        return {'start': start, 'end': end, 'current_hour': current_hour}
+
+
 class CityWeatherForecast(serializers.ModelSerializer):
     """
     Serializer for the city weather forecast retrieving
@@ -87,4 +158,94 @@ class CityWeatherForecast(serializers.ModelSerializer):
         fields = CitySerializer.Meta.fields + ('forecast',)
 
     def get_forecast(self, city):
-        return (WeatherForecastSerializer(item).data for item in city.weather_forecasts.all())
+        return [WeatherForecastSerializer(item).data for item in city.weather_forecasts.all()]
+
+
+class FastWeatherForecastSerializer:
+    """
+    Read-only fast path of CityWeatherForecast for many cities.
+    Forecasts are read by one values_list query without model and serializer instances,
+    every column is converted by one shared serializer field only if the database value differs from its representation
+
+    """
+    def __init__(self) -> None:
+        fields = WeatherForecastSerializer().fields
+        self.datetime_field = fields['datetime']
+        # columns after datetime and local_datetime in the order of the serializer fields
+        self.columns = WeatherForecastSerializer.Meta.fields[2:]
+        self.converters = [
+            (index, fields[name].to_representation)
+            for index, name in enumerate(self.columns)
+            if not self._is_raw(fields[name])
+        ]
+
+    @staticmethod
+    def _is_raw(field: serializers.Field) -> bool:
+        """
+        Check the field representation is the database value
+        :param field: serializer field
+        :return: True if the value doesn't need conversion
+
+        """
+        if isinstance(field, serializers.DecimalField):
+            # decimal columns have the scale of the field
+            return not getattr(field, 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING)
+        return type(field) in (serializers.CharField, serializers.ReadOnlyField)
+
+    def get_cities_forecasts(
+            self,
+            cities: Iterable[models.City],
+            start: datetime = None,
+            end: datetime = None
+    ) -> dict[int, list[dict]]:
+        """
+        Get serialized weather forecasts of the cities
+        :param cities: cities
+        :param start: first forecast time, all forecasts by default
+        :param end: forecast time range end (excluded), all forecasts by default
+        :return: forecasts in the WeatherForecastSerializer representation by the city id
+
+        """
+        # local time offset is calculated once per city
+        offsets = {city.pk: timedelta(seconds=city.timezone) for city in cities}
+        forecasts = {city_id: [] for city_id in offsets}
+        if not offsets:
+            return forecasts
+
+        forecasts_queryset = models.WeatherForecast.objects.filter(city__in=list(offsets))
+        if start:
+            forecasts_queryset = forecasts_queryset.filter(datetime__gte=start)
+        if end:
+            forecasts_queryset = forecasts_queryset.filter(datetime__lt=end)
+
+        rows = forecasts_queryset.order_by('datetime').values_list('city', 'datetime', *self.columns)\
+            .iterator(chunk_size=settings.BATCH_CHUNK_SIZE)
+        datetime_representation = self.datetime_field.to_representation
+        columns = self.columns
+        for city_id, moment, *values in rows:
+            for index, convert in self.converters:
+                values[index] = convert(values[index])
+
+            forecast = {'datetime': datetime_representation(moment), 'local_datetime': moment + offsets[city_id]}
+            forecast.update(zip(columns, values))
+            forecasts[city_id].append(forecast)
+
+        return forecasts
+
+    def get_cities_data(
+            self,
+            cities: Iterable[models.City],
+            start: datetime = None,
+            end: datetime = None
+    ) -> list[dict]:
+        """
+        Get serialized cities with weather forecasts
+        :param cities: cities
+        :param start: first forecast time, all forecasts by default
+        :param end: forecast time range end (excluded), all forecasts by default
+        :return: cities in the CityWeatherForecast representation
+
+        """
+        cities = list(cities)
+        forecasts = self.get_cities_forecasts(cities, start, end)
+        return [{**CitySerializer(city).data, 'forecast': forecasts[city.pk]} for city in cities]
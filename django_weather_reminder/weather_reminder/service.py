@@ -1,19 +1,123 @@
-from datetime import datetime, timezone
-from collections.abc import Iterable
+import logging
+import math
+import random
+from smtplib import SMTPServerDisconnected, SMTPRecipientsRefused, SMTPSenderRefused, SMTPDataError
+from datetime import datetime, timedelta, timezone
+from collections import defaultdict
+from itertools import groupby
+from operator import attrgetter
+from dataclasses import dataclass, fields
+from decimal import Decimal, ROUND_HALF_UP
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from collections.abc import Iterable, Iterator
 
 from django.conf import settings
-from django.core.mail import BadHeaderError, EmailMessage
+from django.db import transaction
+from django.db.models import Count, Max, Min, Q, QuerySet, prefetch_related_objects
+from django.core.mail import BadHeaderError, EmailMessage, get_connection
 from rest_framework.exceptions import NotFound
-from rest_framework.renderers import JSONRenderer
 
-from weather_reminder.models import City, WeatherForecast, LastUpdateTime, Subscription
+from weather_reminder.models import (
+    City,
+    WeatherForecast,
+    LastUpdateTime,
+    Subscription,
+    EmailOutbox,
+    NotificationSettings,
+)
 from weather_reminder.openweather import OpenWeatherConnector
+from weather_reminder.ratelimit import RateLimitedConnector, Priority, INTERACTIVE, TokenBucket, get_email_rate_limiter
+from weather_reminder.caching import CachedConnector
+from weather_reminder.attachments import ForecastAttachment, attachment_formats
+from weather_reminder.serializers import FastWeatherForecastSerializer
 from weather_reminder.connector import ServiceConnector, WeatherForecastData, CityData, round_coordinate
-from weather_reminder.serializers import CityWeatherForecast
 
 
 user_model = settings.AUTH_USER_MODEL
 
+logger = logging.getLogger(__name__)
+
+# notification hours are counted from this moment
+notification_epoch = datetime(2022, 1, 1, tzinfo=timezone.utc)
+
+# the weather service forecast covers 5 days, older forecasts are equally useless
+max_forecast_age = timedelta(days=5)
+
+
+# mean Earth radius, km
+earth_radius = 6371.0
+
+
+def get_distance(latitude1: float, longitude1: float, latitude2: float, longitude2: float) -> float:
+    """
+    Gets the great-circle distance between two points (haversine formula)
+    :return: distance in km
+
+    """
+    latitude1, longitude1, latitude2, longitude2 = map(math.radians, (latitude1, longitude1, latitude2, longitude2))
+    a = math.sin((latitude2 - latitude1) / 2) ** 2 + \
+        math.cos(latitude1) * math.cos(latitude2) * math.sin((longitude2 - longitude1) / 2) ** 2
+    return 2 * earth_radius * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def get_divisors(number: int) -> list[int]:
+    """
+    Gets all divisors of the number
+    :param number: positive integer
+    :return: sorted divisors
+
+    """
+    small_divisors = [divisor for divisor in range(1, math.isqrt(number) + 1) if number % divisor == 0]
+    return sorted(set(small_divisors + [number // divisor for divisor in small_divisors]))
+
+
+def get_notification_hour(moment: datetime) -> int:
+    """
+    Gets the number of the hour for subscriptions notification
+    :param moment: date and time
+    :return: number of hours from 2022.01.01 to the moment
+
+    """
+    return int((moment - notification_epoch).total_seconds() // (60*60))
+
+
+def get_send_offset(user_id: int) -> timedelta:
+    """
+    Gets the stable delay of sending to the user from the start of the notification hour,
+    users are spread evenly across the first EMAIL_SEND_WINDOW minutes of the hour
+    :param user_id: user id
+    :return: delay from the start of the hour
+
+    """
+    window = settings.EMAIL_SEND_WINDOW * 60
+    if window <= 0:
+        return timedelta()
+
+    # multiplicative (Knuth) hash, consecutive ids get distant offsets
+    return timedelta(seconds=(user_id * 2654435761) % 2**32 * window // 2**32)
+
+
+def iterate_by_keyset(queryset: QuerySet, key: str = 'pk', chunk_size: int = None) -> Iterator[list]:
+    """
+    Iterates the queryset in chunks ordered by the unique key. Every chunk is fetched by a separate query
+    that starts after the last key of the previous chunk, so memory use doesn't depend on the table size
+    and no cursor is kept open between chunks
+    :param queryset: queryset of model instances or values() dicts
+    :param key: unique field for ordering
+    :param chunk_size: maximum chunk length, BATCH_CHUNK_SIZE by default
+    :return: iterator of chunks
+
+    """
+    chunk_size = chunk_size or settings.BATCH_CHUNK_SIZE
+    queryset = queryset.order_by(key)
+    chunk_queryset = queryset
+    while chunk := list(chunk_queryset[:chunk_size]):
+        yield chunk
+
+        last = chunk[-1]
+        last_key = last[key] if isinstance(last, dict) else getattr(last, key)
+        chunk_queryset = queryset.filter(**{f'{key}__gt': last_key})
+
 
 class CityNotFound(NotFound):
     """
@@ -26,6 +130,58 @@ class CityNotFound(NotFound):
         super().__init__(*args, **kwargs)
 
 
+class Statistics:
+    """
+    Base class for counters dataclasses, counters are summed by +
+
+    """
+    def __add__(self, other):
+        return type(self)(**{
+            field.name: getattr(self, field.name) + getattr(other, field.name)
+            for field in fields(self)
+        })
+
+
+@dataclass
+class ForecastUpdateStatistics(Statistics):
+    """
+    Counts of the weather forecast update:
+        inserted: new forecast time slots
+        updated: changed forecast time slots
+        deleted: aged out forecast time slots
+        unchanged: forecast time slots which are the same as stored ones
+        cities: cities which forecast was requested
+        skipped: cities which forecast is the same as the last stored one (by fingerprint)
+        failed: cities which forecast request failed
+
+    """
+    inserted: int = 0
+    updated: int = 0
+    deleted: int = 0
+    unchanged: int = 0
+    cities: int = 0
+    skipped: int = 0
+    failed: int = 0
+
+    @property
+    def skip_rate(self) -> float:
+        return self.skipped / self.cities if self.cities else 0.0
+
+
+@dataclass
+class SendStatistics(Statistics):
+    """
+    Counts of the weather forecast sending, in users:
+        sent: emails sent
+        failed: emails which were not sent because of errors
+        skipped: emails which can't be sent (wrong headers)
+
+    """
+    sent: int = 0
+    failed: int = 0
+    skipped: int = 0
+
+
 class WeatherInterface:
     """
     Interface for online weather services.
@@ -34,24 +190,83 @@ class WeatherInterface:
 
     """
     service_connector: ServiceConnector
+    concurrency: int
+
+    def __init__(self, service_connector=None, concurrency: int = None, priority: Priority = INTERACTIVE):
+        """
+        :param service_connector: weather service connector,
+                                  cached and rate limited openweather connector by default
+        :param concurrency: number of simultaneous weather forecast requests during the update
+        :param priority: rate limiter priority of weather forecast requests, 'bulk' for the background updates
 
-    def __init__(self, service_connector=None):
+        """
         self.service_connector = service_connector
+        self.concurrency = concurrency or settings.WEATHER_UPDATE_CONCURRENCY
 
         if self.service_connector is None:
-            self.service_connector = OpenWeatherConnector()
+            self.service_connector = CachedConnector(RateLimitedConnector(OpenWeatherConnector(), priority=priority))
+
+    # forecast fields which are overwritten when the (city, datetime) forecast already exists
+    forecast_update_fields = [field.name for field in fields(WeatherForecastData) if field.name != 'datetime']
 
     @staticmethod
     def _save_weather_forecasts(city: City, weather_forecasts: list[WeatherForecastData]) -> None:
         """
-        Save weather forecasts to the database
+        Save weather forecasts to the database.
+        All forecasts for the city are written with one INSERT ... ON CONFLICT (city, datetime) DO UPDATE statement
         :param city: City instance
         :param weather_forecasts: received from the weather service forecast
 
         """
-        # possible it needs to make a bulk update or create
-        for forecast in weather_forecasts:
-            WeatherForecast.objects.update_or_create(city=city, **forecast.__dict__)
+        WeatherForecast.objects.bulk_create(
+            [WeatherForecast(city=city, **forecast.__dict__) for forecast in weather_forecasts],
+            update_conflicts=True,
+            unique_fields=['city', 'datetime'],
+            update_fields=WeatherInterface.forecast_update_fields,
+        )
+
+    @staticmethod
+    def get_nearest_stored_city(latitude: float, longitude: float, distance: float = None) -> City | None:
+        """
+        Get the nearest city from the database within the distance from the coordinates.
+        Cities are preselected by the bounding box of the distance, which uses
+        the (latitude, longitude) index of the unique_coordinates constraint
+        :param latitude: latitude coordinate
+        :param longitude: longitude coordinate
+        :param distance: maximum distance in km, NEAREST_CITY_DISTANCE by default
+        :return: City instance or None if no city within the distance
+
+        """
+        latitude, longitude = float(latitude), float(longitude)
+        distance = settings.NEAREST_CITY_DISTANCE if distance is None else distance
+        if distance <= 0:
+            return None
+
+        latitude_delta = math.degrees(distance / earth_radius)
+        # longitude degrees shrink towards the poles
+        longitude_delta = min(180.0, latitude_delta / max(math.cos(math.radians(latitude)), 0.01))
+
+        longitude_filter = Q(longitude__gte=longitude - longitude_delta, longitude__lte=longitude + longitude_delta)
+        # the bounding box crosses the antimeridian
+        if longitude - longitude_delta < -180:
+            longitude_filter |= Q(longitude__gte=longitude - longitude_delta + 360)
+        if longitude + longitude_delta > 180:
+            longitude_filter |= Q(longitude__lte=longitude + longitude_delta - 360)
+
+        candidates = City.objects.filter(
+            longitude_filter,
+            latitude__gte=latitude - latitude_delta,
+            latitude__lte=latitude + latitude_delta,
+        )
+
+        nearest = None
+        nearest_distance = distance
+        for city in candidates:
+            city_distance = get_distance(latitude, longitude, float(city.latitude), float(city.longitude))
+            if city_distance <= nearest_distance:
+                nearest, nearest_distance = city, city_distance
+
+        return nearest
 
     def get_nearest_city(self, latitude: float, longitude: float) -> CityData | None:
         """
@@ -76,7 +291,8 @@ class WeatherInterface:
     def get_city(self, latitude: float, longitude: float) -> City:
         """
         Get a city by the coordinates from the database, if a city with such coordinates was not found in the database -
-        try to find the nearest city in the database.
+        try to find the nearest city within NEAREST_CITY_DISTANCE km in the database,
+        and only then the nearest city by the weather service.
         Raise CityNotFound exception if the nearest city with such coordinates was not found in db
         Raise NotFound exception if no city with such coordinates
         :param latitude: latitude coordinate
@@ -87,6 +303,10 @@ class WeatherInterface:
         try:
             city = City.objects.get(latitude=round_coordinate(latitude), longitude=round_coordinate(longitude))
         except City.DoesNotExist:
+            city = self.get_nearest_stored_city(latitude, longitude)
+            if city is not None:
+                return city
+
             # get the nearest city by the coordinates
             city_data = self.get_nearest_city(latitude, longitude)
 
@@ -133,37 +353,300 @@ class WeatherInterface:
         # take timezone from weather forecast
         weather_forecast, timezone = self.service_connector.get_city_weather_forecast(city_data)
 
-        city = City.objects.create(**city_data.__dict__, timezone=timezone)
-        city.save()
-
-        self._save_weather_forecasts(city=city, weather_forecasts=weather_forecast)
+        with transaction.atomic():
+            city = City.objects.create(**city_data.__dict__, timezone=timezone)
+            self._save_weather_forecasts(city=city, weather_forecasts=weather_forecast)
 
         return city
 
-    def update_city_weather_forecast(self, city: City) -> None:
+    @staticmethod
+    def _normalize_forecast_value(field_name: str, value):
+        """
+        Convert a forecast value to the form it's stored in the database
+        :param field_name: WeatherForecast field name
+        :param value: field value
+        :return: normalized value
+
         """
-        Gets city weather forecast data from the weather service,
-        clear all previous forecasts for the city and store received forecasts in the database.
+        field = WeatherForecast._meta.get_field(field_name)
+        if field.get_internal_type() == 'DecimalField':
+            # postgres rounds numeric values half away from zero
+            return field.to_python(value).quantize(Decimal(1).scaleb(-field.decimal_places), ROUND_HALF_UP)
+
+        return value
+
+    @staticmethod
+    def _store_city_weather_forecast(
+            city: City,
+            weather_forecast: list[WeatherForecastData],
+            fingerprint: str = ''
+    ) -> ForecastUpdateStatistics:
+        """
+        Compare received forecasts with stored ones: insert new time slots, update changed time slots
+        and delete aged out time slots, unchanged time slots are not touched.
         :param city: city
+        :param weather_forecast: received from the weather service forecast
+        :param fingerprint: fingerprint of the received forecast
+        :return: update counts
+
+        """
+        statistics = ForecastUpdateStatistics()
+        update_fields = WeatherInterface.forecast_update_fields
+        normalize = WeatherInterface._normalize_forecast_value
+
+        # one transaction per city, readers never see a partially updated forecast
+        with transaction.atomic():
+            stored = {
+                row[0]: row[1:]
+                for row in WeatherForecast.objects.filter(city=city).values_list('datetime', *update_fields)
+            }
+
+            changed = []
+            for forecast in weather_forecast:
+                stored_values = stored.pop(forecast.datetime, None)
+                if stored_values is None:
+                    statistics.inserted += 1
+                elif stored_values != tuple(normalize(name, getattr(forecast, name)) for name in update_fields):
+                    statistics.updated += 1
+                else:
+                    statistics.unchanged += 1
+                    continue
+
+                changed.append(forecast)
+
+            if changed:
+                WeatherInterface._save_weather_forecasts(city, changed)
+
+            # all remaining stored time slots are absent in the received forecast
+            if stored:
+                statistics.deleted, _ = WeatherForecast.objects.filter(city=city, datetime__in=stored.keys()).delete()
+
+            city.forecast_fingerprint = fingerprint
+            city.forecast_updated = datetime.now(timezone.utc)
+            City.objects.filter(pk=city.pk).update(
+                forecast_fingerprint=city.forecast_fingerprint,
+                forecast_updated=city.forecast_updated,
+            )
+
+        return statistics
+
+    def _fetch_weather_forecasts(
+            self,
+            cities: Iterable[City]
+    ) -> Iterator[tuple[City, list[WeatherForecastData] | None, str | None, Exception | None]]:
+        """
+        Requests weather forecasts for the cities from the weather service in a thread pool.
+        No more than 2 * concurrency requests are in flight, so cities are consumed lazily.
+        :param cities: cities for the weather forecast requesting
+        :return: iterator of (city, forecast, fingerprint, None) for succeeded requests
+                 or (city, None, None, error) for failed ones, in order of completion.
+                 Forecast is None if it's the same as the last stored one
+
+        """
+        cities = iter(cities)
+        pending: dict[Future, City] = {}
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            def submit_next() -> bool:
+                city = next(cities, None)
+                if city is None:
+                    return False
+
+                future = executor.submit(
+                    self.service_connector.get_city_weather_forecast_if_changed,
+                    city.toCityData(),
+                    city.forecast_fingerprint
+                )
+                pending[future] = city
+                return True
+
+            while len(pending) < 2 * self.concurrency and submit_next():
+                pass
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    city = pending.pop(future)
+                    try:
+                        weather_forecast, _, fingerprint = future.result()
+                    except Exception as e:
+                        yield city, None, None, e
+                    else:
+                        yield city, weather_forecast, fingerprint, None
+
+                    submit_next()
+
+    @staticmethod
+    def get_city_ids_for_update(budget: int = None) -> list[int]:
+        """
+        Ranks cities for the weather forecast update and takes the most important ones within the budget.
+        City rank grows with the number of subscribers and the forecast age
+        and falls with the number of hours until the next notification for the city subscribers.
+        Cities without subscribers are updated only if their forecast is older
+        than WEATHER_UPDATE_UNSUBSCRIBED_INTERVAL hours, after all subscribed cities.
+        Cities are read in chunks and only ranks are kept in memory
+        :param budget: maximum number of cities (weather service calls), WEATHER_UPDATE_BUDGET by default, 0 - no limit
+        :return: city ids in the update order
 
         """
+        budget = settings.WEATHER_UPDATE_BUDGET if budget is None else budget
+        unsubscribed_interval = timedelta(hours=settings.WEATHER_UPDATE_UNSUBSCRIBED_INTERVAL)
+        now = datetime.now(timezone.utc)
+        # updated forecasts are sent from the next hour
+        next_hour = get_notification_hour(now) + 1
+
+        frequencies = defaultdict(set)
+        subscription_frequencies = Subscription.objects.values_list('city', 'notification_frequency').distinct()
+        for city_id, frequency in subscription_frequencies.iterator(chunk_size=settings.BATCH_CHUNK_SIZE):
+            frequencies[city_id].add(frequency)
+
+        ranked = []
+        cities = City.objects.annotate(subscribers=Count('subscribed_users'))\
+            .values('id', 'forecast_updated', 'subscribers')
+        for chunk in iterate_by_keyset(cities, key='id'):
+            for city in chunk:
+                updated = city['forecast_updated']
+                age = min(now - updated, max_forecast_age) if updated else max_forecast_age
+
+                if city['subscribers']:
+                    hours_until_notification = min((-next_hour) % frequency for frequency in frequencies[city['id']])
+                    rank = city['subscribers'] * (1 + age / timedelta(hours=1)) / (1 + hours_until_notification)
+                elif settings.WEATHER_UPDATE_UNSUBSCRIBED_INTERVAL and age >= unsubscribed_interval:
+                    rank = 0
+                else:
+                    continue
+
+                ranked.append((rank, age, city['id']))
+
+        ranked.sort(key=lambda item: item[:2], reverse=True)
+        city_ids = [city_id for _, _, city_id in ranked]
+
+        return city_ids[:budget] if budget else city_ids
 
-        weather_forecast, timezone = self.service_connector.get_city_weather_forecast(city=city.toCityData())
+    @staticmethod
+    def iterate_cities(city_ids: list[int], chunk_size: int = None) -> Iterator[City]:
+        """
+        Gets cities by ids in chunks, so only one chunk of cities is in memory at once
+        :param city_ids: city ids
+        :param chunk_size: maximum chunk length, BATCH_CHUNK_SIZE by default
+        :return: iterator of existing cities in the order of ids
+
+        """
+        chunk_size = chunk_size or settings.BATCH_CHUNK_SIZE
+        for start in range(0, len(city_ids), chunk_size):
+            chunk_ids = city_ids[start:start + chunk_size]
+            cities = City.objects.in_bulk(chunk_ids)
+            yield from (cities[city_id] for city_id in chunk_ids if city_id in cities)
+
+    @staticmethod
+    def get_random_cities(number: int, attempts: int = 3) -> list[City]:
+        """
+        Gets random cities with prefetched weather forecasts without reading the whole city table.
+        Random ids are drawn from the id range, so gaps in ids are retried up to attempts times
+        and the missing cities are taken in the id order from a random id
+        :param number: number of cities
+        :param attempts: number of random id draws
+        :return: up to number distinct cities
+
+        """
+        bounds = City.objects.aggregate(first=Min('id'), last=Max('id'))
+        if bounds['first'] is None:
+            return []
+
+        id_range = range(bounds['first'], bounds['last'] + 1)
+        cities = {}
+        for _ in range(attempts):
+            if len(cities) >= number:
+                break
+            # several candidates per missing city, ids of deleted cities are skipped
+            candidates = random.sample(id_range, min(len(id_range), (number - len(cities)) * 4))
+            found = list(City.objects.filter(id__in=candidates).exclude(id__in=cities).order_by())
+            cities.update((city.pk, city) for city in random.sample(found, min(len(found), number - len(cities))))
+
+        if len(cities) < number:
+            # cities after a random id in the id order, wrapped around to the first city
+            start = random.choice(id_range)
+            for part in (City.objects.filter(id__gte=start), City.objects.filter(id__lt=start)):
+                if missing := number - len(cities):
+                    cities.update((city.pk, city) for city in part.exclude(id__in=cities).order_by('id')[:missing])
+
+        cities = list(cities.values())
+        prefetch_related_objects(cities, 'weather_forecasts')
+        return cities
+
+    @staticmethod
+    def mark_weather_forecast_updated() -> None:
+        """
+        Stores the time of the last successful weather forecast update
 
-        WeatherForecast.objects.filter(city=city).delete()
+        """
+        LastUpdateTime.mark_updated(LastUpdateTime.Key.FORECAST)
 
-        self._save_weather_forecasts(city, weather_forecast)
+    def update_cities_weather_forecast(self, cities: Iterable[City]) -> ForecastUpdateStatistics:
+        """
+        Gets weather forecast data from the weather service for the cities
+        and stores changes of forecasts in the database,
+        forecasts which are the same as the last stored ones are skipped.
+        Forecasts are requested concurrently while received ones are stored,
+        a failed request for one city doesn't abort the update for the others.
+        :param cities: cities for updating
+        :return: update counts
 
-    def update_weather_forecast(self) -> None:
         """
-        Gets weather forecast data from the weather service for all cities in the database,
-        clear all previous forecasts and store received forecasts in the database.
+        statistics = ForecastUpdateStatistics()
+        skipped_cities = []
+        for city, weather_forecast, fingerprint, error in self._fetch_weather_forecasts(cities):
+            statistics.cities += 1
+            if error is not None:
+                statistics.failed += 1
+                logger.warning('Weather forecast update for the city %s failed: %s', city, error)
+                continue
+
+            if weather_forecast is None:
+                # the forecast is not changed since the last update
+                statistics.skipped += 1
+                skipped_cities.append(city.pk)
+                continue
+
+            statistics += self._store_city_weather_forecast(city, weather_forecast, fingerprint)
+
+        # unchanged forecasts are up-to-date as well
+        City.objects.filter(pk__in=skipped_cities).update(forecast_updated=datetime.now(timezone.utc))
 
+        logger.info('Weather forecast update: %s, skip rate: %.2f', statistics, statistics.skip_rate)
+
+        return statistics
+
+    def update_weather_forecast(self) -> ForecastUpdateStatistics:
         """
-        for city in City.objects.all():
-            self.update_city_weather_forecast(city)
+        Gets weather forecast data from the weather service for the cities selected by get_city_ids_for_update
+        and stores changes of forecasts in the database.
+        :return: update counts
+
+        """
+        statistics = self.update_cities_weather_forecast(self.iterate_cities(self.get_city_ids_for_update()))
+        self.mark_weather_forecast_updated()
+
+        return statistics
 
-        LastUpdateTime.objects.update_or_create()
+
+class _TrackedMessages(list):
+    """
+    List of email messages which remembers how many messages the email backend took for sending.
+    The backend sends every message right after taking it, so the rate limiter token is taken at that moment
+
+    """
+    taken = 0
+
+    def __init__(self, messages: list[EmailMessage], rate_limiter: TokenBucket = None) -> None:
+        super().__init__(messages)
+        self.rate_limiter = rate_limiter
+
+    def __iter__(self):
+        for self.taken, message in enumerate(super().__iter__(), start=1):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            yield message
 
 
 class WeatherForecastSender:
@@ -172,50 +655,109 @@ class WeatherForecastSender:
 
     """
     @staticmethod
-    def _get_forecast_json_for_city_list(city_list: Iterable[City]) -> str:
-        result = []
-        for city in city_list:
-            serializer = CityWeatherForecast(city)
-            result.append(serializer.data)
+    def _get_forecast_attachment_for_city_list(
+            city_list: Iterable[City],
+            attachment: ForecastAttachment = None,
+            fragments: dict[tuple[str, int], bytes] = None
+    ) -> bytes:
+        """
+        Renders weather forecasts for the cities to the attachment content.
+        Every city is rendered once per fragment kind and its fragment is reused for the next users
+        :param city_list: cities
+        :param attachment: attachment format, JSON by default
+        :param fragments: rendered cities by fragment kind and city id, shared by all users of the sending
+        :return: attachment content
+
+        """
+        attachment = attachment or attachment_formats[NotificationSettings.AttachmentFormat.JSON]
+        fragments = {} if fragments is None else fragments
+
+        new_cities = [city for city in city_list if (attachment.fragment_key, city.pk) not in fragments]
+        if new_cities:
+            # get forecasts for all new cities by one query
+            forecasts = FastWeatherForecastSerializer().get_cities_forecasts(new_cities)
+
+            for city in new_cities:
+                fragments[(attachment.fragment_key, city.pk)] = attachment.render_city(city, forecasts[city.pk])
+
+        return attachment.join([fragments[(attachment.fragment_key, city.pk)] for city in city_list])
+
+    @staticmethod
+    def _get_attachment_format(user: user_model) -> ForecastAttachment:
+        """
+        Gets the forecast attachment format selected by the user
+        :param user: user with selected related notification settings
+        :return: attachment format, JSON if the user has no notification settings
 
-        return JSONRenderer().render(result)
+        """
+        try:
+            return attachment_formats[user.notification_settings.attachment_format]
+        except NotificationSettings.DoesNotExist:
+            return attachment_formats[NotificationSettings.AttachmentFormat.JSON]
 
     @staticmethod
-    def _get_subscriptions_for_sending() -> list[Subscription]:
+    def _get_subscriptions_for_sending(hours: int = None) -> QuerySet[Subscription]:
         """
         Gets subscriptions for sending according to a subscription notification period
+        :param hours: number of hours from 2022.01.01, now by default
         :return Subscriptions with a notification period that fits entirely into the number
-        of hours from 2022.01.01 to now
+        of hours from 2022.01.01, ordered by user
 
         """
-        # number of hours from 2022.01.01 to now
-        delta = datetime.now(timezone.utc) - datetime(2022, 1, 1, tzinfo=timezone.utc)
-        hours = int(delta.total_seconds() // (60*60))
+        if hours is None:
+            # number of hours from 2022.01.01 to now
+            hours = get_notification_hour(datetime.now(timezone.utc))
 
-        subscriptions_for_sending = [
-            subscription
-            for subscription in Subscription.objects.all().select_related('user').select_related('city')
-            if divmod(hours, subscription.notification_frequency)[1] == 0
-        ]
+        subscriptions = Subscription.objects.filter(alerts_only=False)
+        if hours > 0:
+            # a notification period fits entirely into the hours if it's a divisor of the hours,
+            # the filter uses the notification frequency index
+            subscriptions = subscriptions.filter(notification_frequency__in=get_divisors(hours))
 
-        return subscriptions_for_sending
+        return subscriptions.select_related('user__notification_settings').select_related('city')\
+            .order_by('user', 'city')
 
     @staticmethod
-    def _send_forecast_email_to_user(user: user_model, subscriptions: list[Subscription]) -> None:
+    def get_users_for_sending(hours: int, chunk_size: int = None) -> Iterator[list[int]]:
         """
-        Sends forecast to user by email
-        :param user: user
-        :param subscriptions: subscriptions for sending (all)
+        Gets users which have subscriptions for sending in chunks
+        :param hours: number of hours from 2022.01.01
+        :param chunk_size: maximum chunk length, BATCH_CHUNK_SIZE by default
+        :return: iterator of chunks of sorted user ids
+
+        """
+        users = WeatherForecastSender._get_subscriptions_for_sending(hours).values('user').distinct()
+        for chunk in iterate_by_keyset(users, key='user', chunk_size=chunk_size):
+            yield [row['user'] for row in chunk]
+
+    @staticmethod
+    def _group_subscriptions_by_user(
+            subscriptions: Iterable[Subscription]
+    ) -> Iterator[tuple[user_model, list[City]]]:
+        """
+        Groups subscriptions by user in one pass
+        :param subscriptions: subscriptions ordered by user
+        :return: iterator of a user and the user subscribed cities
 
         """
+        for _, user_subscriptions in groupby(subscriptions, key=attrgetter('user_id')):
+            user_subscriptions = list(user_subscriptions)
+            yield user_subscriptions[0].user, [sub.city for sub in user_subscriptions]
 
-        # get city list from subscription
-        city_list = set([
-            sub.city
-            for sub in subscriptions
-            if sub.user == user
-        ])
+    @staticmethod
+    def _create_forecast_email(
+            user: user_model,
+            city_list: list[City],
+            fragments: dict[tuple[str, int], bytes] = None
+    ) -> EmailMessage:
+        """
+        Creates forecast email for the user
+        :param user: user
+        :param city_list: user subscribed cities for sending
+        :param fragments: rendered cities by fragment kind and city id, shared by all users of the sending
+        :return: email message with the forecast in the user attachment format
 
+        """
         mail = EmailMessage(
             subject='You weather forecast.',
             body='',
@@ -223,37 +765,231 @@ class WeatherForecastSender:
             to=[user.email],
         )
 
+        attachment = WeatherForecastSender._get_attachment_format(user)
         mail.attach(
-            filename='forecast.json',
-            content=WeatherForecastSender._get_forecast_json_for_city_list(city_list),
-            mimetype='application/json'
+            filename=attachment.filename,
+            content=WeatherForecastSender._get_forecast_attachment_for_city_list(city_list, attachment, fragments),
+            mimetype=attachment.mimetype
         )
 
-        try:
-            mail.send()
-        except BadHeaderError:
-            # TODO handle sending exception
-            pass
+        return mail
+
+    @staticmethod
+    def send_messages(
+            connection,
+            messages: list[EmailMessage]
+    ) -> tuple[list[EmailMessage], list[EmailMessage], dict[EmailMessage, str]]:
+        """
+        Sends messages by the opened connection in one batch, every message takes the email rate limiter token.
+        If the server closes the connection, reconnects and sends the rest of the batch,
+        the rest of the batch is failed if the server is not available
+        :param connection: opened email backend connection
+        :param messages: email messages
+        :return: sent messages, skipped (wrong) messages and failed messages with errors
+
+        """
+        sent, skipped, failed = [], [], {}
+        attempts = settings.EMAIL_RECONNECT_ATTEMPTS
+        rate_limiter = get_email_rate_limiter()
+        while messages:
+            batch = _TrackedMessages(messages, rate_limiter)
+            try:
+                connection.send_messages(batch)
+                sent.extend(messages)
+                break
+            except (BadHeaderError, OSError) as e:
+                # messages before the current one were sent
+                current = max(batch.taken - 1, 0)
+                sent.extend(messages[:current])
+                messages = messages[current:]
+
+                if isinstance(e, BadHeaderError):
+                    # the wrong message is skipped
+                    skipped.append(messages.pop(0))
+                elif isinstance(e, (SMTPRecipientsRefused, SMTPSenderRefused, SMTPDataError)):
+                    # the message is refused by the server
+                    failed[messages.pop(0)] = str(e)
+                elif isinstance(e, SMTPServerDisconnected) and attempts > 0:
+                    attempts -= 1
+                    try:
+                        connection.close()
+                        connection.open()
+                    except OSError as reconnect_error:
+                        # the server is still not available, the rest of the batch is failed
+                        failed.update((message, str(reconnect_error)) for message in messages)
+                        break
+                else:
+                    # the server is not available, the rest of the batch is failed
+                    failed.update((message, str(e)) for message in messages)
+                    break
+
+        return sent, skipped, failed
+
+    @staticmethod
+    def enqueue_weather_forecast(hours: int) -> int:
+        """
+        Puts forecast emails for users with subscriptions for sending into the outbox, one per user and hour,
+        already enqueued emails are not duplicated. Every email is scheduled at the user send offset within the hour.
+        Users are enqueued in chunks, removes outdated outbox emails
+        :param hours: number of hours from 2022.01.01
+        :return: number of users with subscriptions for sending
+
+        """
+        hour_start = notification_epoch + timedelta(hours=hours)
+        users = 0
+        for user_ids in WeatherForecastSender.get_users_for_sending(hours):
+            EmailOutbox.objects.bulk_create(
+                [
+                    EmailOutbox(user_id=user_id, slot=hours, next_attempt=hour_start + get_send_offset(user_id))
+                    for user_id in user_ids
+                ],
+                ignore_conflicts=True,
+            )
+            users += len(user_ids)
+
+        EmailOutbox.objects.filter(slot__lt=hours - settings.EMAIL_OUTBOX_KEEP_HOURS).delete()
+
+        return users
+
+    @staticmethod
+    def _deliver_outbox_emails(
+            entries: list[EmailOutbox],
+            connection,
+            fragments: dict[tuple[str, int], bytes]
+    ) -> SendStatistics:
+        """
+        Sends forecast emails for the outbox entries and stores the delivery result of every entry
+        :param entries: claimed outbox entries
+        :param connection: opened email backend connection
+        :param fragments: rendered cities by fragment kind and city id, shared by all users of the delivery
+        :return: delivery counts
+
+        """
+        statistics = SendStatistics()
+
+        entries_by_user = {(entry.user_id, entry.slot): entry for entry in entries}
+        messages = {}
+        for slot in sorted({entry.slot for entry in entries}):
+            subscriptions = WeatherForecastSender._get_subscriptions_for_sending(slot).filter(
+                user__in=[entry.user_id for entry in entries if entry.slot == slot]
+            )
+            for user, city_list in WeatherForecastSender._group_subscriptions_by_user(subscriptions):
+                message = WeatherForecastSender._create_forecast_email(user, city_list, fragments)
+                messages[message] = entries_by_user[(user.pk, slot)]
+
+        sent, skipped, failed = WeatherForecastSender.send_messages(connection, list(messages))
+
+        now = datetime.now(timezone.utc)
+        for message in sent:
+            messages[message].status = EmailOutbox.Status.SENT
+            messages[message].sent = now
+        for message in skipped:
+            messages[message].status = EmailOutbox.Status.SKIPPED
+        for message, error in failed.items():
+            entry = messages[message]
+            entry.error = error[:250]
+            if entry.attempts >= settings.EMAIL_DELIVERY_MAX_ATTEMPTS:
+                entry.status = EmailOutbox.Status.FAILED
+            else:
+                entry.status = EmailOutbox.Status.PENDING
+                entry.next_attempt = now + timedelta(
+                    seconds=settings.EMAIL_DELIVERY_RETRY_DELAY * 2 ** (entry.attempts - 1)
+                )
+
+        # users unsubscribed after the email was enqueued
+        delivered = set(messages.values())
+        for entry in entries:
+            if entry not in delivered:
+                entry.status = EmailOutbox.Status.SKIPPED
+
+        EmailOutbox.objects.bulk_update(entries, ['status', 'attempts', 'next_attempt', 'sent', 'error'])
+
+        statistics.sent = len(sent)
+        statistics.failed = sum(1 for entry in entries if entry.status == EmailOutbox.Status.FAILED)
+        statistics.skipped = sum(1 for entry in entries if entry.status == EmailOutbox.Status.SKIPPED)
+        return statistics
+
+    @staticmethod
+    def _get_outbox_emails_for_delivery(now: datetime) -> QuerySet[EmailOutbox]:
+        """
+        Gets pending outbox emails and emails with the expired delivery lease which delivery time has come
+        :param now: delivery time
+        :return: outbox emails
+
+        """
+        return EmailOutbox.objects.filter(
+            status__in=[EmailOutbox.Status.PENDING, EmailOutbox.Status.SENDING],
+            next_attempt__lte=now
+        )
+
+    @staticmethod
+    def has_weather_forecast_for_delivery() -> bool:
+        """
+        Checks if the outbox has emails which delivery time has come
+        :return: True if there are emails for delivery
+
+        """
+        return WeatherForecastSender._get_outbox_emails_for_delivery(datetime.now(timezone.utc)).exists()
 
     @staticmethod
-    def _send_forecasts_by_email(subscriptions: list[Subscription]) -> None:
+    def _get_claim_size() -> int:
         """
-        Sends forecast to all users in subscriptions by email
-        :param subscriptions: subscriptions for sending
+        Gets the number of outbox emails claimed at once: EMAIL_BATCH_SIZE limited by the number of emails
+        which parallel deliveries can send within the delivery lease at EMAIL_RATE_LIMIT.
+        Otherwise the lease of emails waiting for the rate limiter expires and they are sent again
+        :return: number of emails
 
         """
-        # get users list
-        users = set([sub.user for sub in subscriptions])
+        if not settings.EMAIL_RATE_LIMIT:
+            return settings.EMAIL_BATCH_SIZE
 
-        for user in users:
-            WeatherForecastSender._send_forecast_email_to_user(user, subscriptions)
+        # the rate is shared by parallel deliveries
+        per_lease = settings.EMAIL_RATE_LIMIT / 60 * settings.EMAIL_DELIVERY_LEASE / settings.EMAIL_DELIVERY_WORKERS
+        return max(1, min(settings.EMAIL_BATCH_SIZE, int(per_lease)))
 
     @staticmethod
-    def send_weather_forecast() -> None:
+    def _claim_outbox_emails() -> list[EmailOutbox]:
         """
-        Sends forecast to users for subscriptions with a notification period that fits entirely into the number
-        of hours from 2022.01.01 to now
+        Claims a batch of outbox emails for delivery by a short transaction, see _get_claim_size.
+        Claimed emails are leased for EMAIL_DELIVERY_LEASE seconds, parallel deliveries skip them,
+        every claim is a delivery attempt. Emails with the expired lease and without attempts left are failed
+        :return: claimed outbox emails
 
         """
-        subscriptions = WeatherForecastSender._get_subscriptions_for_sending()
-        WeatherForecastSender._send_forecasts_by_email(subscriptions)
+        now = datetime.now(timezone.utc)
+        claim_size = WeatherForecastSender._get_claim_size()
+        with transaction.atomic():
+            emails = WeatherForecastSender._get_outbox_emails_for_delivery(now)
+            emails.filter(
+                status=EmailOutbox.Status.SENDING,
+                attempts__gte=settings.EMAIL_DELIVERY_MAX_ATTEMPTS
+            ).update(status=EmailOutbox.Status.FAILED, error='Delivery lease expired')
+
+            entries = list(
+                emails.select_for_update(skip_locked=True).order_by('next_attempt')[:claim_size]
+            )
+            for entry in entries:
+                entry.status = EmailOutbox.Status.SENDING
+                entry.attempts += 1
+                entry.next_attempt = now + timedelta(seconds=settings.EMAIL_DELIVERY_LEASE)
+            EmailOutbox.objects.bulk_update(entries, ['status', 'attempts', 'next_attempt'])
+
+        return entries
+
+    @staticmethod
+    def deliver_weather_forecast() -> SendStatistics:
+        """
+        Delivers outbox emails which delivery time has come, in batches of EMAIL_BATCH_SIZE.
+        Every batch is claimed before sending, so parallel deliveries don't send the same emails
+        and no database locks are held while emails are sent
+        :return: delivery counts
+
+        """
+        statistics = SendStatistics()
+        fragments = {}
+
+        with get_connection() as connection:
+            while entries := WeatherForecastSender._claim_outbox_emails():
+                statistics += WeatherForecastSender._deliver_outbox_emails(entries, connection, fragments)
+
+        return statistics
@@ -0,0 +1,16 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from weather_reminder.models import City, LastUpdateTime, Subscription
+
+
+@receiver(post_save, sender=City)
+@receiver(post_delete, sender=City)
+def mark_cities_updated(**kwargs) -> None:
+    # forecast updates are saved by queryset updates, they don't change the city list
+    LastUpdateTime.mark_updated(LastUpdateTime.Key.CITIES)
+
+
+@receiver(post_delete, sender=Subscription)
+def mark_subscription_deleted(**kwargs) -> None:
+    LastUpdateTime.mark_updated(LastUpdateTime.Key.SUBSCRIPTION_DELETION)
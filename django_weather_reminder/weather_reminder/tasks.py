@@ -1,13 +1,102 @@
-from celery import shared_task
+from dataclasses import asdict
+from datetime import datetime, timezone
 
-from weather_reminder.service import WeatherInterface, WeatherForecastSender
+from celery import shared_task, chord
+from django.conf import settings
+
+from weather_reminder.alerts import WeatherAlertSender
+from weather_reminder.ratelimit import BULK
+from weather_reminder.service import (
+    WeatherInterface,
+    WeatherForecastSender,
+    ForecastUpdateStatistics,
+    SendStatistics,
+    get_notification_hour,
+)
 
 
 @shared_task
 def update_weather_forecast():
-    WeatherInterface().update_weather_forecast()
+    """
+    Splits cities selected for the update into shards and updates them by parallel subtasks,
+    the last update time is stored only after all subtasks succeed
+
+    """
+    city_ids = WeatherInterface.get_city_ids_for_update()
+    shards = settings.WEATHER_UPDATE_SHARDS
+
+    # cities are dealt round-robin, so every shard starts from the most important cities
+    chord(
+        update_weather_forecast_shard.s(city_ids[shard::shards])
+        for shard in range(shards)
+    )(mark_weather_forecast_updated.s())
+
+
+@shared_task
+def update_weather_forecast_shard(city_ids: list[int]):
+    statistics = WeatherInterface(priority=BULK).update_cities_weather_forecast(
+        WeatherInterface.iterate_cities(city_ids)
+    )
+    return asdict(statistics)
+
+
+@shared_task
+def mark_weather_forecast_updated(shards_statistics: list[dict]):
+    WeatherInterface.mark_weather_forecast_updated()
+    send_weather_alerts.delay()
+    statistics = sum((ForecastUpdateStatistics(**item) for item in shards_statistics), ForecastUpdateStatistics())
+    return asdict(statistics)
 
 
 @shared_task
 def send_weather_forecast():
-    WeatherForecastSender.send_weather_forecast()
+    """
+    Puts forecast emails for users with subscriptions for sending into the outbox,
+    emails are delivered at the user send offsets within the hour by dispatch_email_outbox
+
+    """
+    hours = get_notification_hour(datetime.now(timezone.utc))
+    WeatherForecastSender.enqueue_weather_forecast(hours)
+    dispatch_email_outbox()
+
+
+@shared_task
+def dispatch_email_outbox():
+    """
+    Delivers outbox emails which delivery time has come by parallel subtasks.
+    Runs every minute, so the hour sending is dispatched in small time slices
+
+    """
+    if not WeatherForecastSender.has_weather_forecast_for_delivery():
+        return asdict(SendStatistics())
+
+    chord(
+        deliver_email_outbox.s()
+        for _ in range(settings.EMAIL_DELIVERY_WORKERS)
+    )(summarize_weather_forecast_sending.s())
+
+
+@shared_task
+def deliver_email_outbox():
+    """
+    Delivers pending outbox emails which delivery time has come, including retries of failed deliveries
+
+    """
+    statistics = WeatherForecastSender.deliver_weather_forecast()
+    return asdict(statistics)
+
+
+@shared_task
+def summarize_weather_forecast_sending(chunks_statistics: list[dict]):
+    statistics = sum((SendStatistics(**item) for item in chunks_statistics), SendStatistics())
+    return asdict(statistics)
+
+
+@shared_task
+def send_weather_alerts():
+    """
+    Evaluates subscription alert rules for the updated weather forecasts and notifies users about fired rules
+
+    """
+    statistics = WeatherAlertSender.send_weather_alerts()
+    return asdict(statistics)
@@ -7,8 +7,4 @@ register = template.Library()
 
 @register.simple_tag
 def get_latest_update_date():
-    last_update = LastUpdateTime.objects.first()
-    if last_update is None:
-        return None
-
-    return last_update.updated
+    return LastUpdateTime.get_updated(LastUpdateTime.Key.FORECAST)
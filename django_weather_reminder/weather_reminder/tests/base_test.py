@@ -2,8 +2,10 @@ from datetime import datetime
 
 from django.contrib.auth import get_user_model
 from django.conf import settings
+from django.core.cache import caches
 
 
+from weather_reminder.caching import get_geocoding_cache
 from weather_reminder.models import City, Subscription, WeatherForecast
 
 user_model = get_user_model()
@@ -216,6 +218,10 @@ class BaseTestMixin:
             )
 
     def setUp(self) -> None:
+        # geocoding results of the previous tests are mocked differently
+        get_geocoding_cache().clear()
+        # forecast responses of the previous tests have the same cities and versions
+        caches[settings.FORECAST_CACHE_ALIAS].clear()
         self.client.force_login(self.user)
 
 
@@ -0,0 +1,165 @@
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+import numpy as np
+from django.core import mail
+from django.test import TestCase
+
+from weather_reminder.alerts import ForecastMatrix, WeatherAlertSender, alert_fields, alert_operators
+from weather_reminder.models import AlertRule, City, Subscription, WeatherForecast
+from weather_reminder.openweather import OpenWeatherConnector
+from weather_reminder.service import SendStatistics, WeatherForecastSender, WeatherInterface
+from .base_test import BaseTestMixin, mocked_make_weather_forecast_request
+
+
+class WeatherAlertTest(BaseTestMixin, TestCase):
+    now = datetime(2022, 1, 1, tzinfo=timezone.utc)
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        super().setUpTestData()
+
+        cls.city = cls.create_sample_city()
+        # temperature 1, pop 5, wind speed 7 at 00:00, 01:00 and 02:00
+        cls.create_test_forecast(cls.city, 3)
+        WeatherForecast.objects.filter(city=cls.city, datetime=cls.now + timedelta(hours=2)).update(pop=80)
+
+        cls.subscription = Subscription.objects.create(
+            city=cls.city, user=cls.user, notification_frequency=1, alerts_only=True
+        )
+
+    def setUp(self) -> None:
+        pass
+
+    def create_rule(self, field: str, operator: str, threshold: float, hours_ahead: int = 24) -> AlertRule:
+        return AlertRule.objects.create(
+            subscription=self.subscription, field=field, operator=operator, threshold=threshold,
+            hours_ahead=hours_ahead
+        )
+
+    def test_forecast_matrix(self):
+        other_city = City.objects.create(name='Other', country_code='CC', latitude=1, longitude=1, timezone=0)
+        WeatherForecast.objects.create(
+            city=other_city, datetime=self.now + timedelta(hours=1), temperature=-15, temperature_feels_like=-20,
+            pressure=1000, humidity=90, pop=10, cloudiness=100, wind_speed=20,
+        )
+
+        matrix = ForecastMatrix.load(City.objects.all(), self.now, self.now + timedelta(hours=24), chunk_size=2)
+        self.assertEqual(matrix.city_ids.tolist(), sorted([self.city.pk, other_city.pk]))
+        self.assertEqual(matrix.values.shape, (len(alert_fields), 2, 3))
+
+        temperature = matrix.values[alert_fields.index('temperature')]
+        row = matrix.city_ids.tolist().index(other_city.pk)
+        # the other city has only one forecast
+        self.assertTrue(np.array_equal(temperature[row], [np.nan, -15, np.nan], equal_nan=True))
+
+        def evaluate(city: City, field: str, operator: str, threshold: float, hours: int) -> int:
+            return matrix.evaluate(
+                city_ids=np.array([city.pk]),
+                fields=np.array([alert_fields.index(field)]),
+                operators=np.array([alert_operators.index(operator)]),
+                thresholds=np.array([threshold], dtype=np.float32),
+                ends=np.array([(self.now + timedelta(hours=hours)).timestamp()]),
+            )[0]
+
+        self.assertEqual(evaluate(self.city, 'pop', 'gt', 70, 24), 2)
+        self.assertEqual(evaluate(self.city, 'pop', 'gt', 70, 2), -1)
+        self.assertEqual(evaluate(self.city, 'pop', 'gte', 80, 24), 2)
+        self.assertEqual(evaluate(self.city, 'wind_speed', 'lte', 7, 24), 0)
+        self.assertEqual(evaluate(other_city, 'temperature', 'lt', -10, 24), 1)
+        self.assertEqual(evaluate(other_city, 'temperature', 'gt', -10, 24), -1)
+
+    def test_fired_rules(self):
+        pop_rule = self.create_rule('pop', 'gt', 70)
+        self.create_rule('temperature', 'lt', -10)
+        self.create_rule('pop', 'gt', 70, hours_ahead=1)
+
+        self.assertEqual(WeatherAlertSender.get_fired_rules(self.now), {pop_rule.pk: self.now + timedelta(hours=2)})
+
+    def test_fired_rules_parsed_forecast(self):
+        # pop 85% at 2022-11-14 18:00
+        response = mocked_make_weather_forecast_request()
+        response['list'][1] = dict(response['list'][1], pop=0.85)
+        with patch(
+                'weather_reminder.openweather.OpenWeatherConnector._make_weather_forecast_request',
+                lambda *args: response
+        ):
+            WeatherInterface(OpenWeatherConnector()).update_cities_weather_forecast([self.city])
+
+        pop_rule = self.create_rule('pop', 'gt', 80)
+        self.create_rule('pop', 'gt', 90)
+
+        now = datetime(2022, 11, 14, 14, tzinfo=timezone.utc)
+        self.assertEqual(
+            WeatherAlertSender.get_fired_rules(now),
+            {pop_rule.pk: datetime(2022, 11, 14, 18, tzinfo=timezone.utc)}
+        )
+
+    def test_send_alerts(self):
+        self.create_rule('pop', 'gt', 70)
+        self.create_rule('wind_speed', 'gt', 5)
+        self.create_rule('temperature', 'lt', -10)
+
+        self.assertEqual(WeatherAlertSender.send_weather_alerts(self.now), SendStatistics(sent=1))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, [self.user.email])
+        # fired rules in the local time of the city
+        self.assertEqual(mail.outbox[0].body.splitlines(), [
+            f'{self.city}: Probability of precipitation > 70.0 at 2022-01-01 03:00 (local time)',
+            f'{self.city}: Wind speed > 5.0 at 2022-01-01 01:00 (local time)',
+        ])
+        self.assertEqual(AlertRule.objects.filter(last_fired=self.now).count(), 2)
+
+        # fired rules are not sent again until the cooldown ends
+        with self.settings(WEATHER_ALERT_COOLDOWN=1):
+            self.assertEqual(WeatherAlertSender.send_weather_alerts(self.now + timedelta(minutes=30)), SendStatistics())
+            self.assertEqual(len(mail.outbox), 1)
+            statistics = WeatherAlertSender.send_weather_alerts(self.now + timedelta(hours=1))
+            self.assertEqual(statistics, SendStatistics(sent=1))
+
+    def test_alerts_only_subscription_not_sent(self):
+        self.create_rule('pop', 'gt', 70)
+        self.assertFalse(WeatherForecastSender._get_subscriptions_for_sending(1).exists())
+
+        self.subscription.alerts_only = False
+        self.subscription.save()
+        self.assertTrue(WeatherForecastSender._get_subscriptions_for_sending(1).exists())
+
+    def test_rules_evaluation_vectorized(self):
+        cities = City.objects.bulk_create(
+            City(name=f'City {i}', country_code='CC', latitude=i / 100, longitude=i / 100, timezone=0)
+            for i in range(100)
+        )
+        WeatherForecast.objects.bulk_create(
+            WeatherForecast(
+                city=city, datetime=self.now + timedelta(hours=3 * slot), temperature=i % 30 - 15,
+                temperature_feels_like=0, pressure=1000, humidity=50, pop=slot * 2, cloudiness=0, wind_speed=i % 20,
+            )
+            for i, city in enumerate(cities)
+            for slot in range(40)
+        )
+        # city ids, forecast times and forecast rows
+        with self.assertNumQueries(3):
+            matrix = ForecastMatrix.load(City.objects.all(), self.now, self.now + timedelta(hours=120))
+        # the test city adds forecasts at 01:00 and 02:00
+        self.assertEqual(matrix.values.shape, (len(alert_fields), 101, 42))
+
+        rules = 5000
+        generator = np.random.default_rng(0)
+        city_ids = generator.choice(matrix.city_ids, rules)
+        fields = generator.integers(0, len(alert_fields), rules)
+        operators = generator.integers(0, len(alert_operators), rules)
+        thresholds = generator.uniform(-20, 100, rules).astype(np.float32)
+        ends = self.now.timestamp() + generator.integers(1, 121, rules) * 3600.0
+
+        with self.assertNumQueries(0):
+            first_fired = matrix.evaluate(city_ids, fields, operators, thresholds, ends)
+
+        # every rule is checked one by one
+        compare = {0: np.greater, 1: np.greater_equal, 2: np.less, 3: np.less_equal}
+        for index in range(rules):
+            row = matrix.city_ids.tolist().index(city_ids[index])
+            series = matrix.values[fields[index], row]
+            fired = compare[operators[index]](series, thresholds[index]) & (matrix.times < ends[index])
+            self.assertEqual(first_fired[index], fired.argmax() if fired.any() else -1)
+        self.assertTrue(0 < (first_fired >= 0).sum() < rules)
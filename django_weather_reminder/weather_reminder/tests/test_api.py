@@ -1,13 +1,22 @@
 import json
+from datetime import datetime, timedelta, timezone
 from unittest.mock import patch
 
+from django.conf import settings as django_settings
+from django.db import connection
+from django.db.models import prefetch_related_objects
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse, reverse_lazy
 from django.contrib.auth import get_user_model
 from parameterized import parameterized_class
+from rest_framework.renderers import JSONRenderer
 
 from weather_reminder import serializers
-from weather_reminder.models import City, Subscription
+from weather_reminder.attachments import dump_json
+from weather_reminder.caching import get_forecast_response_cache
+from weather_reminder.models import City, Subscription, NotificationSettings, AlertRule, WeatherForecast
+from weather_reminder.service import WeatherInterface
 from .base_test import (
     BaseTestMixin,
     BaseTestListMixin,
@@ -62,7 +71,7 @@ class APIRootTest(TestCase):
         res = self.client.get(reverse('weather_reminder:api_root'))
         data = res.json()
         self.assertEqual(res.status_code, 200)
-        self.assertEqual(len(data), 7)
+        self.assertEqual(len(data), 9)
 
 
 @parameterized_class(
@@ -71,6 +80,7 @@ class APIRootTest(TestCase):
         (reverse_lazy('weather_reminder:subscriptions_list'),),
         (reverse_lazy('weather_reminder:subscription', kwargs={'latitude': 40, 'longitude': 40}),),
         (reverse_lazy('weather_reminder:forecasts_list'),),
+        (reverse_lazy('weather_reminder:notification_settings'),),
     ]
 )
 class AuthenticationTest(BaseTestMixin, TestCase):
@@ -116,8 +126,10 @@ class CityAPITestList(BaseTestListMixin, TestCase):
         self.assertEqual(res.status_code, 200)
 
         data = res.json()
-        self.pagination_check(data, City.objects.all().count())
+        self.assertIn('next', data)
+        self.assertIn('previous', data)
         result = data['results']
+        self.assertEqual(len(result), django_settings.REST_FRAMEWORK['PAGE_SIZE'])
 
         found_city = City.objects.filter(
             latitude=result[0]['latitude'],
@@ -129,6 +141,36 @@ class CityAPITestList(BaseTestListMixin, TestCase):
         for field in serializers.CitySerializer.Meta.fields:
             self.assertEqual(result[0].get(field), getattr(found_city, field))
 
+    def test_city_list_pages(self):
+        # cities with the same name are ordered by id
+        City.objects.bulk_create(
+            City(name='Same name', country_code='SN', latitude=-i, longitude=-i, timezone=0) for i in range(1, 10)
+        )
+
+        cities, url = [], reverse('weather_reminder:cities')
+        while url:
+            data = self.client.get(url).json()
+            cities += [(city['latitude'], city['longitude']) for city in data['results']]
+            url = data['next']
+
+        expected = City.objects.order_by('name', 'id').values_list('latitude', 'longitude')
+        self.assertEqual(cities, [(float(latitude), float(longitude)) for latitude, longitude in expected])
+
+    def test_city_list_deep_page_queries(self):
+        City.objects.bulk_create(
+            City(name=f'City {i}', country_code='CC', latitude=-i, longitude=-i, timezone=0) for i in range(1, 30)
+        )
+        url = reverse('weather_reminder:cities')
+        for _ in range(3):
+            url = self.client.get(url).json()['next']
+        self.assertTrue(url)
+
+        # session, user, the cities update time for the ETag and the page read after the cursor
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        self.assertEqual(len(queries), 4)
+        self.assertNotIn('OFFSET', queries[-1]['sql'])
+
 
 class SubscriptionListAPITestList(BaseTestListMixin, TestCase):
     def test_subscriptions_list_content(self):
@@ -308,6 +350,21 @@ class SubscriptionModifyTest(BaseTestMixin, TestCase):
         data = res.json()
         self.assertEqual(data.get('notification_frequency'), self.subscription.notification_frequency)
 
+    @patch(
+        'weather_reminder.openweather.OpenWeatherConnector._make_geocoding_request',
+        mocked_make_geocoding_request_city_not_found
+    )
+    def test_get_subscription_nearest_stored_city(self):
+        url = reverse('weather_reminder:subscription', kwargs={'latitude': 39.98, 'longitude': 40.03})
+
+        # the stored city is found without the weather service
+        res = self.client.get(url)
+        self.assertEqual(res.status_code, 200)
+
+        with self.settings(NEAREST_CITY_DISTANCE=0):
+            res = self.client.get(url)
+        self.assertEqual(res.status_code, 404)
+
     def test_modify_subscription(self):
         set_value = {'notification_frequency': 2}
         res = self.client.put(
@@ -329,6 +386,77 @@ class SubscriptionModifyTest(BaseTestMixin, TestCase):
             self.subscription.refresh_from_db()
 
 
+class AlertRuleTest(BaseTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.city = cls.create_sample_city()
+        cls.subscription = Subscription.objects.create(city=cls.city, user=cls.user, notification_frequency=1)
+        cls.url = reverse(
+            'weather_reminder:subscription_alerts',
+            kwargs={'latitude': cls.city.latitude, 'longitude': cls.city.longitude}
+        )
+
+    def test_add_alert_rule(self):
+        rule = {'field': 'pop', 'operator': 'gt', 'threshold': 70.0, 'hours_ahead': 12}
+        res = self.client.post(self.url, data=rule, content_type='application/json')
+        self.assertEqual(res.status_code, 201)
+
+        res = self.client.get(self.url)
+        self.assertEqual(res.status_code, 200)
+        data = res.json()['results']
+        self.assertEqual(len(data), 1)
+        self.assertEqual({key: data[0][key] for key in rule}, rule)
+        self.assertEqual(self.subscription.alert_rules.get().field, AlertRule.Field.POP)
+
+        res = self.client.post(self.url, data={**rule, 'hours_ahead': 200}, content_type='application/json')
+        self.assertEqual(res.status_code, 400)
+
+    def test_modify_alert_rule(self):
+        rule = AlertRule.objects.create(subscription=self.subscription, field='pop', operator='gt', threshold=70)
+        url = reverse('weather_reminder:alert_rule', kwargs={'pk': rule.pk})
+
+        res = self.client.patch(url, data={'threshold': '50.0'}, content_type='application/json')
+        self.assertEqual(res.status_code, 200)
+        rule.refresh_from_db()
+        self.assertEqual(rule.threshold, 50)
+
+        res = self.client.delete(url)
+        self.assertEqual(res.status_code, 204)
+        self.assertFalse(AlertRule.objects.exists())
+
+    def test_foreign_alert_rule(self):
+        other_user = get_user_model().objects.create_user(username='other', email='other@example.com')
+        subscription = Subscription.objects.create(city=self.city, user=other_user, notification_frequency=1)
+        rule = AlertRule.objects.create(subscription=subscription, field='pop', operator='gt', threshold=70)
+
+        res = self.client.get(reverse('weather_reminder:alert_rule', kwargs={'pk': rule.pk}))
+        self.assertEqual(res.status_code, 404)
+
+
+class NotificationSettingsTest(BaseTestMixin, TestCase):
+    def test_get_default_settings(self):
+        res = self.client.get(reverse('weather_reminder:notification_settings'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json(), {'attachment_format': NotificationSettings.AttachmentFormat.JSON})
+
+    def test_modify_settings(self):
+        res = self.client.put(
+            reverse('weather_reminder:notification_settings'),
+            data={'attachment_format': 'csv'},
+            content_type='application/json'
+        )
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self.user.notification_settings.attachment_format, NotificationSettings.AttachmentFormat.CSV)
+
+        res = self.client.put(
+            reverse('weather_reminder:notification_settings'),
+            data={'attachment_format': 'xml'},
+            content_type='application/json'
+        )
+        self.assertEqual(res.status_code, 400)
+
+
 class WeatherForecastListTest(BaseTestListMixin, TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -362,6 +490,98 @@ class WeatherForecastListTest(BaseTestListMixin, TestCase):
         self.assertListEqual(forecast, test_weather_response)
 
 
+class ForecastWindowTest(BaseTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.city = cls.create_sample_city()
+        # forecasts at 00:00, 01:00, 02:00 and 03:00
+        cls.create_test_forecast(cls.city, 4)
+        Subscription.objects.create(city=cls.city, user=cls.user, notification_frequency=1)
+
+    def get_forecast_times(self, params: dict, url: str = None) -> list[str]:
+        url = url or reverse(
+            'weather_reminder:city_forecast',
+            kwargs={'latitude': self.city.latitude, 'longitude': self.city.longitude}
+        )
+        res = self.client.get(url, params)
+        self.assertEqual(res.status_code, 200)
+        data = res.json()
+        forecast = data['results'][0]['forecast'] if 'results' in data else data['forecast']
+        return [item['datetime'] for item in forecast]
+
+    def test_forecast_window(self):
+        self.assertEqual(len(self.get_forecast_times({})), 4)
+        self.assertEqual(
+            self.get_forecast_times({'from': '2022-01-01T01:00:00Z', 'to': '2022-01-01T03:00:00Z'}),
+            ['2022-01-01T01:00:00Z', '2022-01-01T02:00:00Z']
+        )
+        self.assertEqual(
+            self.get_forecast_times({'from': '2022-01-01T02:00:00Z'}),
+            ['2022-01-01T02:00:00Z', '2022-01-01T03:00:00Z']
+        )
+        self.assertEqual(
+            self.get_forecast_times({'from': '2022-01-01T00:30:00Z', 'hours_ahead': 1}),
+            ['2022-01-01T01:00:00Z']
+        )
+        self.assertEqual(
+            self.get_forecast_times({'hours_ahead': 2}, reverse('weather_reminder:forecasts_list')),
+            []
+        )
+        self.assertEqual(
+            self.get_forecast_times({'to': '2022-01-01T01:00:00Z'}, reverse('weather_reminder:forecasts_list')),
+            ['2022-01-01T00:00:00Z']
+        )
+
+    def test_forecast_window_from_current_hour(self):
+        now = datetime(2022, 1, 1, 1, 30, tzinfo=timezone.utc)
+        with patch('django.utils.timezone.now', return_value=now):
+            self.assertEqual(
+                self.get_forecast_times({'hours_ahead': 2}),
+                ['2022-01-01T01:00:00Z', '2022-01-01T02:00:00Z']
+            )
+
+    def test_forecast_window_bounded_in_sql(self):
+        url = reverse(
+            'weather_reminder:city_forecast',
+            kwargs={'latitude': self.city.latitude, 'longitude': self.city.longitude}
+        )
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url, {'from': '2022-01-01T01:00:00Z', 'hours_ahead': 1})
+        forecast_queries = [query['sql'] for query in queries if WeatherForecast._meta.db_table in query['sql']]
+        self.assertEqual(len(forecast_queries), 1)
+        self.assertIn('"datetime" >=', forecast_queries[0])
+        self.assertIn('"datetime" <', forecast_queries[0])
+
+    def test_forecast_window_invalid(self):
+        url = reverse(
+            'weather_reminder:city_forecast',
+            kwargs={'latitude': self.city.latitude, 'longitude': self.city.longitude}
+        )
+        for params in (
+                {'from': 'tomorrow'},
+                {'hours_ahead': 0},
+                {'hours_ahead': 121},
+                {'from': '2022-01-01T02:00:00Z', 'to': '2022-01-01T01:00:00Z'},
+        ):
+            with self.subTest(params):
+                self.assertEqual(self.client.get(url, params).status_code, 400)
+
+    def test_forecast_window_modified_every_hour(self):
+        url = reverse(
+            'weather_reminder:city_forecast',
+            kwargs={'latitude': self.city.latitude, 'longitude': self.city.longitude}
+        )
+        with patch('django.utils.timezone.now', return_value=datetime(2022, 1, 1, 1, 10, tzinfo=timezone.utc)):
+            first = self.client.get(url, {'hours_ahead': 2})
+        with patch('django.utils.timezone.now', return_value=datetime(2022, 1, 1, 1, 50, tzinfo=timezone.utc)):
+            same_hour = self.client.get(url, {'hours_ahead': 2}, HTTP_IF_NONE_MATCH=first.headers['ETag'])
+        with patch('django.utils.timezone.now', return_value=datetime(2022, 1, 1, 2, 10, tzinfo=timezone.utc)):
+            next_hour = self.client.get(url, {'hours_ahead': 2}, HTTP_IF_NONE_MATCH=first.headers['ETag'])
+        self.assertEqual(same_hour.status_code, 304)
+        self.assertEqual(next_hour.status_code, 200)
+
+
 class CityWeatherForecastTest(WeatherForecastListTest):
     def test_weather_forecast(self):
         res = self.client.get(reverse(
@@ -376,3 +596,204 @@ class CityWeatherForecastTest(WeatherForecastListTest):
         self.maxDiff = None
         self.assertListEqual(forecast, test_weather_response)
 
+
+class ForecastResponseCacheTest(BaseTestListMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for city in City.objects.all():
+            cls.create_test_forecast(city, 3)
+
+    def setUp(self) -> None:
+        super().setUp()
+        get_forecast_response_cache().reset_statistics()
+
+    def test_forecast_list_cached(self):
+        url = reverse('weather_reminder:forecasts_list')
+        first = self.client.get(url).json()
+        statistics = get_forecast_response_cache().statistics
+        self.assertEqual((statistics.shared_hits, statistics.misses), (0, 7))
+
+        # session, user, forecast version, subscriptions versions, subscription deletion time, cities count
+        # and cities page, forecasts are not queried
+        with self.assertNumQueries(7):
+            second = self.client.get(url).json()
+        self.assertEqual(second, first)
+        self.assertEqual((statistics.shared_hits, statistics.misses), (7, 7))
+
+    def test_forecast_cache_invalidated_by_update(self):
+        city = City.objects.first()
+        url = reverse(
+            'weather_reminder:city_forecast',
+            kwargs={'latitude': city.latitude, 'longitude': city.longitude}
+        )
+        self.assertEqual(self.client.get(url).json()['forecast'][0]['temperature'], 1)
+
+        WeatherForecast.objects.filter(city=city).update(temperature=10)
+        # the cached forecast is returned until the forecast update
+        self.assertEqual(self.client.get(url).json()['forecast'][0]['temperature'], 1)
+
+        WeatherInterface.mark_weather_forecast_updated()
+        self.assertEqual(self.client.get(url).json()['forecast'][0]['temperature'], 10)
+
+        # the city forecast is updated without the global update
+        WeatherForecast.objects.filter(city=city).update(temperature=20)
+        City.objects.filter(pk=city.pk).update(forecast_updated=datetime.now(timezone.utc))
+        self.assertEqual(self.client.get(url).json()['forecast'][0]['temperature'], 20)
+
+
+class ConditionalGetTest(BaseTestListMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for city in City.objects.all():
+            cls.create_test_forecast(city, 3)
+
+    def setUp(self) -> None:
+        super().setUp()
+        WeatherInterface.mark_weather_forecast_updated()
+        self.city = City.objects.first()
+        self.urls = {
+            'cities': reverse('weather_reminder:cities'),
+            'subscriptions': reverse('weather_reminder:subscriptions_list'),
+            'forecasts': reverse('weather_reminder:forecasts_list'),
+            'forecast': reverse(
+                'weather_reminder:city_forecast',
+                kwargs={'latitude': self.city.latitude, 'longitude': self.city.longitude}
+            ),
+        }
+
+    def test_not_modified_by_etag(self):
+        for name, url in self.urls.items():
+            with self.subTest(name):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(response.headers['ETag'])
+
+                not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=response.headers['ETag'])
+                self.assertEqual(not_modified.status_code, 304)
+                self.assertEqual(not_modified.headers['ETag'], response.headers['ETag'])
+                self.assertFalse(not_modified.content)
+
+                # other pages have other tags
+                self.assertNotEqual(self.client.get(url, {'offset': 1}).headers['ETag'], response.headers['ETag'])
+
+    def test_not_modified_by_last_modified(self):
+        for name in ('forecasts', 'forecast'):
+            with self.subTest(name):
+                response = self.client.get(self.urls[name])
+                not_modified = self.client.get(
+                    self.urls[name], HTTP_IF_MODIFIED_SINCE=response.headers['Last-Modified']
+                )
+                self.assertEqual(not_modified.status_code, 304)
+
+    def test_not_modified_without_forecast_queries(self):
+        etag = self.client.get(self.urls['forecasts']).headers['ETag']
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.urls['forecasts'], HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse([query for query in queries if WeatherForecast._meta.db_table in query['sql']])
+
+    def test_modified_by_forecast_update(self):
+        forecasts = self.client.get(self.urls['forecasts'])
+        forecast = self.client.get(self.urls['forecast'])
+
+        # the city forecast is updated without the global update
+        City.objects.filter(pk=self.city.pk).update(forecast_updated=datetime.now(timezone.utc))
+        for name, response in (('forecasts', forecasts), ('forecast', forecast)):
+            with self.subTest(name):
+                modified = self.client.get(self.urls[name], HTTP_IF_NONE_MATCH=response.headers['ETag'])
+                self.assertEqual(modified.status_code, 200)
+                self.assertNotEqual(modified.headers['ETag'], response.headers['ETag'])
+
+        etag = self.client.get(self.urls['forecast']).headers['ETag']
+        WeatherInterface.mark_weather_forecast_updated()
+        self.assertEqual(self.client.get(self.urls['forecast'], HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_subscriptions_modified(self):
+        etag = self.client.get(self.urls['subscriptions']).headers['ETag']
+        Subscription.objects.filter(user=self.user, city=self.city).update(notification_frequency=12)
+        self.assertEqual(self.client.get(self.urls['subscriptions'], HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_forecasts_modified_by_subscriptions(self):
+        # Last-Modified has one second resolution, changes are made later
+        later = datetime.now(timezone.utc) + timedelta(minutes=1)
+        last_modified = self.client.get(self.urls['forecasts']).headers['Last-Modified']
+        city = City.objects.create(name='New city', country_code='CC', latitude=-1, longitude=-1, timezone=0)
+        with patch('django.utils.timezone.now', return_value=later):
+            subscription = Subscription.objects.create(city=city, user=self.user, notification_frequency=1)
+        modified = self.client.get(self.urls['forecasts'], HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(modified.status_code, 200)
+
+        last_modified = modified.headers['Last-Modified']
+        self.assertEqual(
+            self.client.get(self.urls['forecasts'], HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304
+        )
+        with patch('django.utils.timezone.now', return_value=later + timedelta(minutes=1)):
+            subscription.delete()
+        self.assertEqual(
+            self.client.get(self.urls['forecasts'], HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 200
+        )
+
+    def test_cities_modified(self):
+        etag = self.client.get(self.urls['cities']).headers['ETag']
+        self.city.name = 'Renamed city'
+        self.city.save()
+        modified = self.client.get(self.urls['cities'], HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(modified.status_code, 200)
+
+        etag = modified.headers['ETag']
+        City.objects.exclude(pk=self.city.pk).first().delete()
+        self.assertEqual(self.client.get(self.urls['cities'], HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_cities_not_modified_by_forecast_update(self):
+        etag = self.client.get(self.urls['cities']).headers['ETag']
+        City.objects.filter(pk=self.city.pk).update(forecast_updated=datetime.now(timezone.utc))
+        # session, user and the cities update time
+        with self.assertNumQueries(3):
+            response = self.client.get(self.urls['cities'], HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+
+class FastWeatherForecastSerializerTest(BaseTestListMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cities = list(City.objects.order_by('pk'))
+        for index, city in enumerate(cities[1:]):
+            city.timezone = (index - 3) * 1800
+            city.save()
+            cls.create_test_forecast(city, 3)
+
+        # fractional values and microseconds, the first city has no forecasts
+        WeatherForecast.objects.filter(city=cities[1]).update(temperature=-12.3, wind_speed=0.5, pressure=1013)
+        WeatherForecast.objects.create(
+            city=cities[2], datetime=datetime(2022, 1, 2, 3, 4, 5, 678901, tzinfo=timezone.utc), temperature=0.1,
+            temperature_feels_like=-0.1, pressure=990, humidity=100, pop=0, cloudiness=100, wind_speed=12.5,
+            weather_description='',
+        )
+
+    def assert_parity(self) -> list[dict]:
+        cities = list(City.objects.order_by('pk'))
+        fast = serializers.FastWeatherForecastSerializer().get_cities_data(cities)
+
+        prefetch_related_objects(cities, 'weather_forecasts')
+        expected = [dict(serializers.CityWeatherForecast(city).data) for city in cities]
+        self.assertEqual(fast, expected)
+        self.assertEqual(dump_json(fast), dump_json(expected))
+        self.assertEqual(JSONRenderer().render(fast), JSONRenderer().render(expected))
+        return fast
+
+    def test_parity(self):
+        self.assert_parity()
+
+    def test_parity_decimal_strings(self):
+        with self.settings(REST_FRAMEWORK={**django_settings.REST_FRAMEWORK, 'COERCE_DECIMAL_TO_STRING': True}):
+            data = self.assert_parity()
+        self.assertEqual(data[1]['forecast'][0]['temperature'], '-12.3')
+
+    def test_one_query(self):
+        cities = list(City.objects.all())
+        with self.assertNumQueries(1):
+            forecasts = serializers.FastWeatherForecastSerializer().get_cities_forecasts(cities)
+        self.assertEqual(sum(map(len, forecasts.values())), WeatherForecast.objects.count())
@@ -10,4 +10,4 @@ class PeriodicTasksCreationTest(TestCase):
     def test_periodic_tasks_created(self):
         app_name = 'weather_reminder'
         WeatherReminderConfig(app_name, app_module=import_module(app_name)).ready()
-        self.assertEqual(PeriodicTask.objects.count(), 2)
+        self.assertEqual(PeriodicTask.objects.count(), 3)
@@ -0,0 +1,223 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import uuid
+from threading import Thread
+from unittest.mock import patch, MagicMock
+
+from django.conf import settings
+from django.core.cache import caches
+from django.test import SimpleTestCase
+from urllib3 import HTTPResponse
+
+from weather_reminder.caching import GeocodingCache, CachedConnector, TTLCache
+from weather_reminder.connector import CityData
+from weather_reminder.openweather import CappedRetry, OpenWeatherConnector
+from weather_reminder.ratelimit import (
+    MemoryTokenBucket, RedisTokenBucket, RateLimitedConnector, get_rate_limiter, BULK, INTERACTIVE
+)
+from .base_test import mocked_make_weather_forecast_request
+
+
+class OpenWeatherSessionTest(SimpleTestCase):
+    def test_session_shared(self):
+        self.assertIs(OpenWeatherConnector().get_session(), OpenWeatherConnector().get_session())
+
+    def test_session_retries(self):
+        adapter = OpenWeatherConnector.get_session().get_adapter('https://api.openweathermap.org/')
+        # throttled calls wait for the rate limiter instead
+        self.assertNotIn(429, adapter.max_retries.status_forcelist)
+        self.assertIn(503, adapter.max_retries.status_forcelist)
+        self.assertTrue(adapter.max_retries.respect_retry_after_header)
+
+    def test_retry_wait_capped(self):
+        retry = CappedRetry(total=10, backoff_factor=60, status_forcelist=(503,))
+        response = HTTPResponse(status=503, headers={'Retry-After': '3600'})
+        with self.settings(OPENWEATHER_RETRY_MAX_WAIT=5):
+            self.assertEqual(retry.get_retry_after(response), 5)
+            retry = retry.increment('GET', '/', response=response).increment('GET', '/', response=response)
+            self.assertEqual(retry.get_backoff_time(), 5)
+
+    def test_forecast_request_uses_session(self):
+        response = MagicMock()
+        response.json.return_value = mocked_make_weather_forecast_request()
+
+        with patch.object(OpenWeatherConnector.get_session(), 'get', return_value=response) as mocked_get:
+            forecast, timezone = OpenWeatherConnector().get_city_weather_forecast(
+                CityData(name='City', country_code='CC', latitude=1, longitude=1)
+            )
+
+        self.assertEqual(len(forecast), 4)
+        self.assertEqual(timezone, 3600)
+        self.assertIn('timeout', mocked_get.call_args.kwargs)
+
+    def test_parse_pop_percent(self):
+        response = mocked_make_weather_forecast_request()
+        response['list'][1] = dict(response['list'][1], pop=0.37)
+
+        forecast, _ = OpenWeatherConnector._parse_weather_forecast_response(response)
+
+        self.assertEqual([moment.pop for moment in forecast], [0, 37, 0, 0])
+
+    def test_pool_statistics(self):
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive connections
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'{}')
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        session = OpenWeatherConnector._create_session()
+        self.addCleanup(session.close)
+        url = f'http://127.0.0.1:{server.server_port}/'
+        with patch.object(OpenWeatherConnector, '_session', session):
+            self.assertEqual(OpenWeatherConnector.pool_statistics(), {})
+            for _ in range(3):
+                session.get(url).raise_for_status()
+
+            statistics = OpenWeatherConnector.pool_statistics()
+
+        # one connection is reused for all requests and returned to the pool
+        self.assertEqual(statistics, {
+            f'http://127.0.0.1:{server.server_port}': {'connections': 1, 'requests': 3, 'idle': 1},
+        })
+
+
+class RateLimiterTest(SimpleTestCase):
+    def test_bulk_calls_keep_reserve(self):
+        bucket = MemoryTokenBucket(rate=1, capacity=4, reserve=2)
+
+        self.assertEqual(bucket._try_acquire(1, bucket.reserve), 0)
+        self.assertEqual(bucket._try_acquire(1, bucket.reserve), 0)
+        # reserved tokens are available only for interactive calls
+        self.assertGreater(bucket._try_acquire(1, bucket.reserve), 0)
+        self.assertEqual(bucket._try_acquire(1, 0), 0)
+
+    def test_acquire_waits_for_refill(self):
+        bucket = MemoryTokenBucket(rate=1, capacity=1)
+        bucket.acquire(BULK)
+
+        def sleep(seconds: float) -> None:
+            # the bucket is refilled as if the time passed
+            bucket._timestamp -= seconds
+
+        with patch('weather_reminder.ratelimit.time.sleep', side_effect=sleep) as mocked_sleep:
+            bucket.acquire(BULK)
+
+        self.assertTrue(mocked_sleep.called)
+        self.assertLessEqual(mocked_sleep.call_args.args[0], 1)
+
+    def test_rate_limited_connector(self):
+        bucket = MagicMock()
+        service_connector = MagicMock()
+        connector = RateLimitedConnector(service_connector, rate_limiter=bucket, priority=BULK)
+
+        connector.get_city_info_by_coordinates({'lat': 1, 'lon': 1})
+        connector.get_city_weather_forecast(CityData(name='City', country_code='CC', latitude=1, longitude=1))
+
+        self.assertEqual([call.args[0] for call in bucket.acquire.call_args_list], [INTERACTIVE, BULK])
+        self.assertTrue(service_connector.get_city_weather_forecast.called)
+
+    def test_rate_limit_disabled(self):
+        get_rate_limiter.cache_clear()
+        self.addCleanup(get_rate_limiter.cache_clear)
+        service_connector = MagicMock()
+        with self.settings(OPENWEATHER_RATE_LIMIT=0):
+            self.assertIsNone(get_rate_limiter())
+            RateLimitedConnector(service_connector).get_cities_info_by_name('City')
+
+        self.assertTrue(service_connector.get_cities_info_by_name.called)
+        with self.assertRaises(ValueError):
+            MemoryTokenBucket(rate=0, capacity=1)
+
+
+class RedisTokenBucketTest(SimpleTestCase):
+    def setUp(self) -> None:
+        import redis
+
+        client = redis.Redis.from_url(settings.CELERY_BROKER_URL)
+        try:
+            client.ping()
+        except (redis.RedisError, ValueError):
+            self.skipTest('Redis is not available')
+
+        self.key = f'weather_reminder:test_rate_limit:{uuid.uuid4()}'
+        self.addCleanup(client.delete, self.key)
+
+    def test_bulk_calls_keep_reserve(self):
+        bucket = RedisTokenBucket(rate=1, capacity=4, reserve=2, key=self.key)
+
+        self.assertEqual(bucket._try_acquire(1, bucket.reserve), 0)
+        self.assertEqual(bucket._try_acquire(1, bucket.reserve), 0)
+        # reserved tokens are available only for interactive calls
+        self.assertGreater(bucket._try_acquire(1, bucket.reserve), 0)
+        self.assertEqual(bucket._try_acquire(1, 0), 0)
+        self.assertEqual(bucket._try_acquire(1, 0), 0)
+
+        # the empty bucket gets one token per second
+        self.assertAlmostEqual(bucket._try_acquire(1, 0), 1, delta=0.1)
+
+
+class GeocodingCacheTest(SimpleTestCase):
+    def setUp(self) -> None:
+        self.geocoding_cache = GeocodingCache(size=10, ttl=60, negative_ttl=10)
+        self.geocoding_cache.clear()
+        self.service_connector = MagicMock()
+        self.connector = CachedConnector(self.service_connector, geocoding_cache=self.geocoding_cache)
+
+    def test_reverse_geocoding_cached(self):
+        city = CityData(name='City', country_code='CC', latitude=1, longitude=1)
+        self.service_connector.get_city_info_by_coordinates.return_value = [city]
+
+        self.assertEqual(self.connector.get_city_info_by_coordinates({'lat': 1.00001, 'lon': 1}), [city])
+        # the same rounded coordinates
+        self.assertEqual(self.connector.get_city_info_by_coordinates({'lat': 1, 'lon': 1.00002}), [city])
+
+        self.assertEqual(self.service_connector.get_city_info_by_coordinates.call_count, 1)
+        self.assertEqual(self.geocoding_cache.statistics.misses, 1)
+        self.assertEqual(self.geocoding_cache.statistics.memory_hits, 1)
+
+    def test_shared_tier(self):
+        self.service_connector.get_cities_info_by_name.return_value = []
+
+        self.assertEqual(self.connector.get_cities_info_by_name('Nowhere'), [])
+        self.geocoding_cache.memory_cache.clear()
+        # not found result is cached as well
+        self.assertEqual(self.connector.get_cities_info_by_name(' nowhere'), [])
+
+        self.assertEqual(self.service_connector.get_cities_info_by_name.call_count, 1)
+        self.assertEqual(self.geocoding_cache.statistics.shared_hits, 1)
+
+    def test_clear_keeps_other_caches(self):
+        caches['default'].set('weather_reminder:test', 1)
+        self.addCleanup(caches['default'].delete, 'weather_reminder:test')
+        self.service_connector.get_cities_info_by_name.return_value = []
+        self.connector.get_cities_info_by_name('Nowhere')
+
+        self.geocoding_cache.clear()
+        self.assertEqual(caches['default'].get('weather_reminder:test'), 1)
+        self.connector.get_cities_info_by_name('Nowhere')
+        self.assertEqual(self.service_connector.get_cities_info_by_name.call_count, 2)
+
+    def test_ttl_expiration(self):
+        ttl_cache = TTLCache(size=2)
+        ttl_cache.set('expired', 1, ttl=-1)
+        ttl_cache.set('first', 1, ttl=60)
+        ttl_cache.set('second', 2, ttl=60)
+        ttl_cache.set('third', 3, ttl=60)
+
+        self.assertIsNone(ttl_cache.get('expired', None))
+        # least recently used value is evicted
+        self.assertIsNone(ttl_cache.get('first', None))
+        self.assertEqual(ttl_cache.get('third'), 3)
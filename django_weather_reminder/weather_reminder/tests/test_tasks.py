@@ -1,14 +1,46 @@
+import csv
+import gzip
+import io
 import json
+from collections import Counter
+from smtplib import SMTPServerDisconnected, SMTPDataError
+import tracemalloc
+from types import SimpleNamespace
+from dataclasses import replace
 from unittest.mock import patch
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 
+from django.conf import settings
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model, get_user
 from django.core import mail
+from django.core.mail import EmailMessage
+from rest_framework.renderers import JSONRenderer
 
-
-from weather_reminder.models import LastUpdateTime, Subscription, WeatherForecast
-from weather_reminder.service import WeatherInterface, WeatherForecastSender
+from django_weather_reminder.celery import app as celery_app
+from weather_reminder import tasks
+from weather_reminder.attachments import attachment_formats
+from weather_reminder.models import (
+    City,
+    LastUpdateTime,
+    Subscription,
+    WeatherForecast,
+    EmailOutbox,
+    NotificationSettings,
+)
+from weather_reminder.serializers import CityWeatherForecast, WeatherForecastSerializer
+from weather_reminder.service import (
+    WeatherInterface,
+    WeatherForecastSender,
+    ForecastUpdateStatistics,
+    SendStatistics,
+    get_notification_hour,
+    get_send_offset,
+    iterate_by_keyset,
+    notification_epoch,
+)
 from .base_test import BaseTestMixin, mocked_make_weather_forecast_request
 
 
@@ -31,24 +63,506 @@ class WeatherForecastTasksTest(BaseTestMixin, TestCase):
     def setUp(self) -> None:
         pass
 
+    def create_users(self, number: int, start: int = 0) -> None:
+        """
+        Creates users subscribed to the test city with the hourly notification
+        :param number: number of users
+        :param start: number of the first user
+
+        """
+        users = get_user_model().objects.bulk_create(
+            get_user_model()(username=f'bulk_user_{i}', email=f'bulk_user_{i}@example.com')
+            for i in range(start, start + number)
+        )
+        Subscription.objects.bulk_create(
+            Subscription(city=self.city, user=user, notification_frequency=1) for user in users
+        )
+
     def test_forecast_update(self):
         WeatherInterface().update_weather_forecast()
 
         self.assertEqual(WeatherForecast.objects.count(), 4)
-        self.assertEqual(LastUpdateTime.objects.count(), 1)
+        self.assertTrue(LastUpdateTime.objects.filter(key=LastUpdateTime.Key.FORECAST).exists())
 
-    def test_forecast_send(self):
+    def test_forecast_update_incremental(self):
+        interface = WeatherInterface()
+        statistics = interface.update_weather_forecast()
+        self.assertEqual(statistics, ForecastUpdateStatistics(inserted=4, cities=1))
+
+        # the first time slot aged out, the second one changed, the new time slot added
+        response = mocked_make_weather_forecast_request()
+        response['list'] = response['list'][1:] + [dict(response['list'][-1], dt=1668481200)]
+        response['list'][0] = dict(response['list'][0], main=dict(response['list'][0]['main'], temp=-3))
+        with patch(
+                'weather_reminder.openweather.OpenWeatherConnector._make_weather_forecast_request',
+                lambda *args: response
+        ):
+            statistics = interface.update_weather_forecast()
+
+        self.assertEqual(statistics, ForecastUpdateStatistics(inserted=1, updated=1, deleted=1, unchanged=2, cities=1))
+        self.assertEqual(WeatherForecast.objects.count(), 4)
+        self.assertEqual(WeatherForecast.objects.get(datetime=datetime.fromtimestamp(1668448800, tz=timezone.utc))
+                         .temperature, -3)
+
+    def test_forecast_update_unchanged_skipped(self):
+        interface = WeatherInterface()
+        interface.update_weather_forecast()
+
+        with patch('weather_reminder.service.WeatherInterface._store_city_weather_forecast') as mocked_store:
+            statistics = interface.update_weather_forecast()
+
+        self.assertFalse(mocked_store.called)
+        self.assertEqual(statistics, ForecastUpdateStatistics(cities=1, skipped=1))
+        self.assertEqual(statistics.skip_rate, 1)
+
+    def test_forecast_update_city_failure_isolated(self):
+        failed_city = City.objects.create(name='Failed', country_code='CC', latitude=1, longitude=1, timezone=0)
+
+        def make_weather_forecast_request(connector, city):
+            if city.name == failed_city.name:
+                raise ValueError('Wrong response')
+            return mocked_make_weather_forecast_request()
+
+        with patch(
+                'weather_reminder.openweather.OpenWeatherConnector._make_weather_forecast_request',
+                make_weather_forecast_request
+        ):
+            WeatherInterface(concurrency=2).update_weather_forecast()
+
+        self.assertEqual(WeatherForecast.objects.filter(city=self.city).count(), 4)
+        self.assertEqual(WeatherForecast.objects.filter(city=failed_city).count(), 0)
+        self.assertTrue(LastUpdateTime.objects.filter(key=LastUpdateTime.Key.FORECAST).exists())
+
+    def test_forecast_update_schedule(self):
+        popular_city = City.objects.create(name='Popular', country_code='CC', latitude=1, longitude=1, timezone=0)
+        for i in range(3):
+            user = get_user_model().objects.create_user(username=f'user_{i}', email=f'user_{i}@example.com')
+            Subscription.objects.create(city=popular_city, user=user, notification_frequency=1)
+
+        stale_city = City.objects.create(name='Stale', country_code='CC', latitude=2, longitude=2, timezone=0)
+        City.objects.create(
+            name='Fresh', country_code='CC', latitude=3, longitude=3, timezone=0,
+            forecast_updated=datetime.now(timezone.utc)
+        )
+
+        # cities without subscribers go last, fresh ones are not updated
+        expected = [popular_city.pk, self.city.pk, stale_city.pk]
+        self.assertEqual(WeatherInterface.get_city_ids_for_update(), expected)
+        self.assertEqual(WeatherInterface.get_city_ids_for_update(budget=1), expected[:1])
+
+        with self.settings(WEATHER_UPDATE_UNSUBSCRIBED_INTERVAL=0):
+            self.assertEqual(WeatherInterface.get_city_ids_for_update(), expected[:2])
+
+        # the ranking doesn't depend on the chunk size
+        with self.settings(BATCH_CHUNK_SIZE=1):
+            self.assertEqual(WeatherInterface.get_city_ids_for_update(), expected)
+            cities = list(WeatherInterface.iterate_cities(expected[::-1]))
+            self.assertEqual(cities, [stale_city, self.city, popular_city])
+
+    def test_iterate_by_keyset(self):
+        cities = [
+            City.objects.create(name=f'City {i}', country_code='CC', latitude=i, longitude=i, timezone=0)
+            for i in range(5)
+        ]
+        cities.insert(0, self.city)
+
+        chunks = list(iterate_by_keyset(City.objects.all(), chunk_size=2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 2])
+        self.assertEqual([city for chunk in chunks for city in chunk], cities)
+
+        # every chunk is a separate query
+        with self.assertNumQueries(4):
+            chunks = list(iterate_by_keyset(City.objects.values('id'), key='id', chunk_size=2))
+        self.assertEqual([row['id'] for chunk in chunks for row in chunk], [city.pk for city in cities])
+
+    def test_forecast_update_task(self):
+        celery_app.conf.task_always_eager = True
+        try:
+            tasks.update_weather_forecast()
+        finally:
+            celery_app.conf.task_always_eager = False
+
+        self.assertEqual(WeatherForecast.objects.count(), 4)
+        self.assertTrue(LastUpdateTime.objects.filter(key=LastUpdateTime.Key.FORECAST).exists())
+
+    def test_forecast_save_upsert(self):
+        interface = WeatherInterface()
+        forecasts, _ = interface.service_connector.get_city_weather_forecast(self.city.toCityData())
+        interface._save_weather_forecasts(self.city, forecasts)
+
+        # the same slots with the new values are updated in place
+        changed = [replace(forecast, temperature=-5.0) for forecast in forecasts]
+        interface._save_weather_forecasts(self.city, changed)
+
+        self.assertEqual(WeatherForecast.objects.count(), 4)
+        self.assertEqual(WeatherForecast.objects.filter(temperature=-5).count(), 4)
+
+    def test_subscriptions_for_sending(self):
         with patch('weather_reminder.service.datetime') as mock_datetime:
-            mock_datetime.now.return_value = datetime(2022, 1, 1, hour=2, tzinfo=timezone.utc)
-            mock_datetime.side_effect = lambda *args, **kwargs: datetime(*args, **kwargs)
-            WeatherForecastSender.send_weather_forecast()
-            self.assertEqual(len(mail.outbox), 1)
-            self.assertEqual(mail.outbox[0].subject, "You weather forecast.")
-            self.assertIn(self.user.email, mail.outbox[0].to)
-            self.assertEqual(len(mail.outbox[0].attachments), 1)
-            self.assertIn('forecast', json.loads(mail.outbox[0].attachments[0][1])[0])
+            for hour, frequencies in ((2, {2}), (3, {3}), (5, set()), (6, {2, 3})):
+                mock_datetime.now.return_value = datetime(2022, 1, 1, hour=hour, tzinfo=timezone.utc)
+                subscriptions = WeatherForecastSender._get_subscriptions_for_sending()
+                self.assertEqual({sub.notification_frequency for sub in subscriptions}, frequencies)
+
+    def test_forecast_send_grouped_by_user(self):
+        city = City.objects.create(name='Other', country_code='CC', latitude=1, longitude=1, timezone=0)
+        Subscription.objects.create(city=city, user=self.user, notification_frequency=1)
+
+        WeatherForecastSender.enqueue_weather_forecast(6)
+        WeatherForecastSender.deliver_weather_forecast()
+
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), ['user2@example.com', self.user.email])
+        user_mail = next(message for message in mail.outbox if message.to == [self.user.email])
+        self.assertEqual(len(json.loads(user_mail.attachments[0][1])), 2)
+
+    def test_forecast_send_renders_city_once(self):
+        self.create_test_forecast(self.city, 3)
+        users = [
+            get_user_model().objects.create_user(username=f'user_{i}', email=f'user_{i}@example.com')
+            for i in range(5)
+        ]
+        for user in users:
+            Subscription.objects.create(city=self.city, user=user, notification_frequency=1)
+
+        WeatherForecastSender.enqueue_weather_forecast(1)
+        with CaptureQueriesContext(connection) as queries:
+            WeatherForecastSender.deliver_weather_forecast()
+
+        # one forecast query for the city and nothing per user
+        forecast_queries = [query for query in queries if WeatherForecast._meta.db_table in query['sql']]
+        self.assertEqual(len(forecast_queries), 1)
+
+        self.assertEqual(len(mail.outbox), 5)
+        attachment = json.loads(mail.outbox[-1].attachments[0][1])
+        self.assertEqual(len(attachment[0]['forecast']), 3)
+        self.assertEqual(mail.outbox[0].attachments[0][1], mail.outbox[-1].attachments[0][1])
+
+    def test_forecast_attachment_formats(self):
+        self.create_test_forecast(self.city, 3)
+        city = City.objects.prefetch_related('weather_forecasts').get(pk=self.city.pk)
+        expected = [json.loads(JSONRenderer().render(CityWeatherForecast(city).data))]
+        fragments = {}
+
+        def render(attachment_format: str) -> bytes:
+            return WeatherForecastSender._get_forecast_attachment_for_city_list(
+                [city], attachment_formats[attachment_format], fragments
+            )
+
+        # the same JSON as the DRF renderer
+        self.assertEqual(json.loads(render('json')), expected)
+        self.assertEqual(json.loads(gzip.decompress(render('json.gz'))), expected)
+
+        columnar = json.loads(render('columnar'))
+        self.assertEqual(len(columnar), 1)
+        for field in WeatherForecastSerializer.Meta.fields:
+            self.assertEqual(columnar[0]['forecast'][field], [item[field] for item in expected[0]['forecast']])
+
+        rows = list(csv.DictReader(io.StringIO(render('csv').decode())))
+        self.assertEqual(len(rows), 3)
+        for row, item in zip(rows, expected[0]['forecast']):
+            self.assertEqual(row['name'], city.name)
+            for field, value in item.items():
+                self.assertEqual(row[field] if isinstance(value, str) else float(row[field]), value)
+
+        # compressed JSON reuses JSON fragments
+        self.assertEqual({key for key, _ in fragments}, {'json', 'columnar', 'csv'})
+
+    def test_forecast_send_user_attachment_format(self):
+        self.create_test_forecast(self.city, 3)
+        NotificationSettings.objects.create(user=self.user, attachment_format='json.gz')
+
+        WeatherForecastSender.enqueue_weather_forecast(6)
+        WeatherForecastSender.deliver_weather_forecast()
+
+        attachments = {message.to[0]: message.attachments[0] for message in mail.outbox}
+        filename, content, mimetype = attachments[self.user.email]
+        self.assertEqual((filename, mimetype), ('forecast.json.gz', 'application/gzip'))
+        self.assertEqual(gzip.decompress(content), attachments['user2@example.com'][1])
+
+    def test_send_messages_reconnect(self):
+        class DisconnectingConnection:
+            def __init__(self):
+                self.delivered = []
+                self.opened = 0
+                self.disconnect_after = 2
+
+            def send_messages(self, messages):
+                for message in messages:
+                    if len(self.delivered) == self.disconnect_after:
+                        self.disconnect_after = None
+                        raise SMTPServerDisconnected()
+                    self.delivered.append(message)
+                return len(messages)
+
+            def open(self):
+                self.opened += 1
 
+            def close(self):
+                pass
 
+        connection = DisconnectingConnection()
+        messages = [EmailMessage(to=[f'user_{i}@example.com']) for i in range(5)]
 
+        sent, skipped, failed = WeatherForecastSender.send_messages(connection, messages)
+        self.assertEqual(sent, messages)
+        self.assertEqual(skipped, [])
+        self.assertEqual(failed, {})
+        self.assertEqual(connection.delivered, messages)
+        self.assertEqual(connection.opened, 1)
 
+    def test_forecast_deliver_reconnect_failed(self):
+        WeatherForecastSender.enqueue_weather_forecast(6)
 
+        # the connection is opened for the delivery, the server is down when reconnecting
+        with patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                   side_effect=SMTPServerDisconnected()), \
+                patch('django.core.mail.backends.locmem.EmailBackend.open',
+                      side_effect=[None, ConnectionRefusedError('Connection refused')]):
+            self.assertEqual(WeatherForecastSender.deliver_weather_forecast(), SendStatistics())
+
+        # failed emails wait for the retry
+        entries = EmailOutbox.objects.all()
+        self.assertEqual(entries.count(), 2)
+        for entry in entries:
+            self.assertEqual((entry.status, entry.attempts, entry.error),
+                             (EmailOutbox.Status.PENDING, 1, 'Connection refused'))
+            self.assertGreater(entry.next_attempt, datetime.now(timezone.utc))
+
+    def test_forecast_send_batches(self):
+        for i in range(5):
+            user = get_user_model().objects.create_user(username=f'user_{i}', email=f'user_{i}@example.com')
+            Subscription.objects.create(city=self.city, user=user, notification_frequency=1)
+
+        WeatherForecastSender.enqueue_weather_forecast(1)
+        with self.settings(EMAIL_BATCH_SIZE=2), \
+                patch('django.core.mail.backends.locmem.EmailBackend.send_messages', autospec=True) as mocked_send:
+            mocked_send.side_effect = lambda backend, messages: len(messages)
+            self.assertEqual(WeatherForecastSender.deliver_weather_forecast(), SendStatistics(sent=5))
+
+        self.assertEqual([len(call.args[1]) for call in mocked_send.call_args_list], [2, 2, 1])
+        # all batches are sent by one connection
+        self.assertEqual(len({id(call.args[0]) for call in mocked_send.call_args_list}), 1)
+
+    def test_forecast_send_task(self):
+        celery_app.conf.task_always_eager = True
+        try:
+            with patch('weather_reminder.tasks.datetime') as mock_datetime:
+                mock_datetime.now.return_value = datetime(2022, 1, 1, hour=6, tzinfo=timezone.utc)
+                tasks.send_weather_forecast()
+        finally:
+            celery_app.conf.task_always_eager = False
+
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), ['user2@example.com', self.user.email])
+
+        # every email is delivered once
+        self.assertFalse(EmailOutbox.objects.exclude(status=EmailOutbox.Status.SENT).exists())
+
+    def test_forecast_enqueue_idempotent(self):
+        self.assertEqual(WeatherForecastSender.enqueue_weather_forecast(6), 2)
+        self.assertEqual(WeatherForecastSender.enqueue_weather_forecast(6), 2)
+        self.assertEqual(EmailOutbox.objects.filter(slot=6).count(), 2)
+
+        # outdated emails are removed
+        WeatherForecastSender.enqueue_weather_forecast(6 + settings.EMAIL_OUTBOX_KEEP_HOURS + 1)
+        self.assertFalse(EmailOutbox.objects.filter(slot=6).exists())
+
+    def test_send_offset(self):
+        offsets = [get_send_offset(user_id) for user_id in range(1, 1001)]
+
+        # the offset of the user is stable and within the send window
+        self.assertEqual(offsets, [get_send_offset(user_id) for user_id in range(1, 1001)])
+        window = timedelta(minutes=settings.EMAIL_SEND_WINDOW)
+        self.assertTrue(all(timedelta() <= offset < window for offset in offsets))
+
+        # users are spread evenly across the window
+        minutes = Counter(int(offset.total_seconds() // 60) for offset in offsets)
+        self.assertEqual(len(minutes), settings.EMAIL_SEND_WINDOW)
+        self.assertLess(max(minutes.values()), 2 * 1000 / settings.EMAIL_SEND_WINDOW)
+
+        with self.settings(EMAIL_SEND_WINDOW=0):
+            self.assertEqual(get_send_offset(1), timedelta())
+
+    def test_forecast_enqueue_spread(self):
+        hours = get_notification_hour(datetime.now(timezone.utc)) + 1
+        for i in range(6):
+            user = get_user_model().objects.create_user(username=f'user_{i}', email=f'user_{i}@example.com')
+            Subscription.objects.create(city=self.city, user=user, notification_frequency=1)
+
+        WeatherForecastSender.enqueue_weather_forecast(hours)
+
+        hour_start = notification_epoch + timedelta(hours=hours)
+        for entry in EmailOutbox.objects.all():
+            self.assertEqual(entry.next_attempt, hour_start + get_send_offset(entry.user_id))
+
+        # emails of the next hour are not delivered yet
+        self.assertFalse(WeatherForecastSender.has_weather_forecast_for_delivery())
+        self.assertEqual(WeatherForecastSender.deliver_weather_forecast(), SendStatistics())
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_forecast_enqueue_chunked(self):
+        self.create_users(5)
+        with self.settings(BATCH_CHUNK_SIZE=2), self.assertNumQueries(4 + 3 + 1):
+            # 4 user chunk queries, 3 inserts and the outdated emails removal
+            self.assertEqual(WeatherForecastSender.enqueue_weather_forecast(1), 5)
+        self.assertEqual(EmailOutbox.objects.count(), 5)
+
+    def test_forecast_enqueue_memory_flat(self):
+        def measure() -> int:
+            EmailOutbox.objects.all().delete()
+            tracemalloc.start()
+            try:
+                WeatherForecastSender.enqueue_weather_forecast(1)
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        with self.settings(BATCH_CHUNK_SIZE=100):
+            self.create_users(200)
+            small = measure()
+            self.create_users(1600, start=200)
+            large = measure()
+
+        self.assertEqual(EmailOutbox.objects.count(), 1800)
+        # 9 times more users, peak memory is bounded by the chunk size
+        self.assertLess(large, 2 * small)
+
+    def test_forecast_deliver_outbox(self):
+        WeatherForecastSender.enqueue_weather_forecast(6)
+
+        statistics = WeatherForecastSender.deliver_weather_forecast()
+        self.assertEqual(statistics, SendStatistics(sent=2))
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(EmailOutbox.objects.filter(status=EmailOutbox.Status.SENT, sent__isnull=False).count(), 2)
+
+        # sent emails are not delivered again
+        WeatherForecastSender.enqueue_weather_forecast(6)
+        self.assertEqual(WeatherForecastSender.deliver_weather_forecast(), SendStatistics())
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_forecast_deliver_outbox_retry(self):
+        WeatherForecastSender.enqueue_weather_forecast(6)
+
+        error = SMTPDataError(451, 'Try again later')
+        with patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=error):
+            statistics = WeatherForecastSender.deliver_weather_forecast()
+
+        # failed emails wait for the retry
+        self.assertEqual(statistics, SendStatistics())
+        self.assertEqual(len(mail.outbox), 0)
+        entries = EmailOutbox.objects.filter(status=EmailOutbox.Status.PENDING)
+        self.assertEqual(entries.count(), 2)
+        self.assertTrue(all(entry.attempts == 1 and entry.error for entry in entries))
+
+        EmailOutbox.objects.update(next_attempt=datetime.now(timezone.utc))
+        self.assertEqual(WeatherForecastSender.deliver_weather_forecast(), SendStatistics(sent=2))
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_forecast_deliver_outbox_failed(self):
+        WeatherForecastSender.enqueue_weather_forecast(6)
+
+        error = SMTPDataError(554, 'Rejected')
+        with self.settings(EMAIL_DELIVERY_MAX_ATTEMPTS=1), \
+                patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=error):
+            statistics = WeatherForecastSender.deliver_weather_forecast()
+
+        self.assertEqual(statistics, SendStatistics(failed=2))
+        self.assertEqual(EmailOutbox.objects.filter(status=EmailOutbox.Status.FAILED).count(), 2)
+
+    def test_forecast_deliver_rate_limited_per_message(self):
+        self.create_users(3)
+        WeatherForecastSender.enqueue_weather_forecast(1)
+
+        class RecordingBucket:
+            # number of sent emails at every token acquiring
+            acquired = []
+
+            def acquire(self):
+                self.acquired.append(len(mail.outbox))
+
+        with patch('weather_reminder.service.get_email_rate_limiter', return_value=RecordingBucket()):
+            self.assertEqual(WeatherForecastSender.deliver_weather_forecast(), SendStatistics(sent=3))
+
+        # the token is taken right before sending every email, not while the batch is built
+        self.assertEqual(RecordingBucket.acquired, [0, 1, 2])
+
+    def test_forecast_deliver_claims_before_sending(self):
+        WeatherForecastSender.enqueue_weather_forecast(6)
+        statuses = []
+
+        def send_messages(backend, messages):
+            statuses.extend(EmailOutbox.objects.values_list('status', flat=True))
+            # parallel deliveries don't get claimed emails
+            self.assertEqual(WeatherForecastSender._claim_outbox_emails(), [])
+            return len(list(messages))
+
+        with patch('django.core.mail.backends.locmem.EmailBackend.send_messages', autospec=True) as mocked_send:
+            mocked_send.side_effect = send_messages
+            self.assertEqual(WeatherForecastSender.deliver_weather_forecast(), SendStatistics(sent=2))
+
+        self.assertEqual(statuses, [EmailOutbox.Status.SENDING] * 2)
+        self.assertEqual(EmailOutbox.objects.filter(status=EmailOutbox.Status.SENT, attempts=1).count(), 2)
+
+    def test_forecast_deliver_expired_lease(self):
+        WeatherForecastSender.enqueue_weather_forecast(6)
+        # the delivery was stopped after claiming the emails
+        WeatherForecastSender._claim_outbox_emails()
+        self.assertFalse(WeatherForecastSender.has_weather_forecast_for_delivery())
+
+        EmailOutbox.objects.filter(user=self.user).update(next_attempt=datetime.now(timezone.utc))
+        EmailOutbox.objects.exclude(user=self.user).update(
+            next_attempt=datetime.now(timezone.utc), attempts=settings.EMAIL_DELIVERY_MAX_ATTEMPTS
+        )
+        self.assertEqual(WeatherForecastSender.deliver_weather_forecast(), SendStatistics(sent=1))
+        self.assertEqual([message.to for message in mail.outbox], [[self.user.email]])
+        self.assertEqual(
+            EmailOutbox.objects.exclude(user=self.user).get().status, EmailOutbox.Status.FAILED
+        )
+
+    def test_forecast_claim_within_lease(self):
+        self.create_users(5)
+        WeatherForecastSender.enqueue_weather_forecast(1)
+
+        # 6 emails per minute shared by 2 deliveries, each sends 2 emails within the lease of 40 seconds
+        with self.settings(EMAIL_RATE_LIMIT=6, EMAIL_DELIVERY_LEASE=40, EMAIL_DELIVERY_WORKERS=2):
+            self.assertEqual(len(WeatherForecastSender._claim_outbox_emails()), 2)
+            with self.settings(EMAIL_DELIVERY_LEASE=1):
+                self.assertEqual(len(WeatherForecastSender._claim_outbox_emails()), 1)
+
+        self.assertEqual(len(WeatherForecastSender._claim_outbox_emails()), 2)
+        self.assertFalse(WeatherForecastSender.has_weather_forecast_for_delivery())
+
+    def test_subscriptions_grouping_single_pass(self):
+        self.create_users(50)
+        # users and cities are selected with the subscriptions
+        with self.assertNumQueries(1):
+            groups = [
+                (user.email, [city.name for city in city_list])
+                for user, city_list in WeatherForecastSender._group_subscriptions_by_user(
+                    WeatherForecastSender._get_subscriptions_for_sending(1)
+                )
+            ]
+        self.assertEqual(len(groups), 50)
+        self.assertTrue(all(cities == [self.city.name] for _, cities in groups))
+
+        consumed = []
+
+        def subscriptions():
+            for user in range(1000):
+                for city in range(3):
+                    consumed.append(user)
+                    yield SimpleNamespace(user_id=user, user=user, city=city)
+
+        # subscriptions are read once and only one user group is held at a time
+        for user, city_list in WeatherForecastSender._group_subscriptions_by_user(subscriptions()):
+            self.assertEqual(city_list, [0, 1, 2])
+            self.assertLessEqual(len(consumed), 3 * user + 4)
+        self.assertEqual(len(consumed), 3000)
+
+    def test_forecast_send(self):
+        WeatherForecastSender.enqueue_weather_forecast(2)
+        WeatherForecastSender.deliver_weather_forecast()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject, "You weather forecast.")
+        self.assertIn(self.user.email, mail.outbox[0].to)
+        self.assertEqual(len(mail.outbox[0].attachments), 1)
+        self.assertIn('forecast', json.loads(mail.outbox[0].attachments[0][1])[0])
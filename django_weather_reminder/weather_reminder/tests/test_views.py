@@ -3,6 +3,7 @@ from django.urls import reverse
 from django.contrib.auth import get_user_model
 
 from weather_reminder.models import City, Subscription
+from weather_reminder.service import WeatherInterface
 from weather_reminder.views import display_forecast_fields
 from .base_test import BaseTestListMixin
 
@@ -43,3 +44,38 @@ class HomePageViewTest(BaseTestListMixin, TestCase):
         context = res.context_data
         self.assertIn('object_list', context)
         self.assertEqual(len(context['object_list']), 3)
+
+    def test_homepage_no_logged_user_queries(self):
+        self.client.logout()
+        for city in City.objects.all():
+            self.create_test_forecast(city, 2)
+
+        # city id bounds, random cities, their forecasts and the last update time,
+        # the number doesn't depend on the city table size
+        with self.assertNumQueries(4):
+            res = self.client.get(reverse('weather_reminder:home'))
+        self.assertEqual(len(res.context_data['object_list']), 3)
+
+    def test_random_cities(self):
+        city_ids = set(City.objects.values_list('id', flat=True))
+
+        cities = WeatherInterface.get_random_cities(3)
+        self.assertEqual(len({city.pk for city in cities}), 3)
+        self.assertTrue({city.pk for city in cities} <= city_ids)
+
+        self.assertEqual({city.pk for city in WeatherInterface.get_random_cities(100)}, city_ids)
+
+    def test_random_cities_sparse_ids(self):
+        # a few cities among many deleted ones
+        cities = City.objects.bulk_create(
+            City(name=f'City {i}', country_code='CC', latitude=-i / 100, longitude=-i / 100, timezone=0)
+            for i in range(1, 301)
+        )
+        kept = {city.pk for city in cities[::100]}
+        City.objects.exclude(pk__in=kept).delete()
+
+        self.assertEqual({city.pk for city in WeatherInterface.get_random_cities(3)}, kept)
+
+    def test_random_cities_empty(self):
+        City.objects.all().delete()
+        self.assertEqual(WeatherInterface.get_random_cities(3), [])
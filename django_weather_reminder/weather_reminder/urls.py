@@ -30,6 +30,18 @@ urlpatterns = [
         'api/v1/subscriptions/<coordinate:latitude>/<coordinate:longitude>/',
         views.SubscriptionAPIView.as_view(),
         name='subscription'),
+    path(
+        'api/v1/subscriptions/<coordinate:latitude>/<coordinate:longitude>/alerts/',
+        views.SubscriptionAlertRulesAPIView.as_view(),
+        name='subscription_alerts'),
+    path(
+        'api/v1/alerts/<int:pk>/',
+        views.AlertRuleAPIView.as_view(),
+        name='alert_rule'),
+    path(
+        'api/v1/settings/',
+        views.NotificationSettingsAPIView.as_view(),
+        name='notification_settings'),
     path(
         'api/v1/forecasts/',
         views.WeatherForecastListAPIView.as_view(),
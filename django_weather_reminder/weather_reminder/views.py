@@ -1,8 +1,11 @@
+from datetime import datetime
 from typing import Literal
-import random
+import hashlib
 
 from django.views import generic
 from django.db import IntegrityError
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date
 from rest_framework import generics as rest_generics
 from rest_framework import views as rest_views
 from rest_framework import mixins as rest_mixins
@@ -15,6 +18,8 @@ from rest_framework.permissions import IsAuthenticated
 from weather_reminder import models
 from weather_reminder import serializers
 from weather_reminder.service import WeatherInterface
+from weather_reminder.caching import ForecastResponseCache, get_forecast_response_cache
+from weather_reminder.pagination import CityCursorPagination
 
 
 display_forecast_fields = [
@@ -53,6 +58,87 @@ class CoordinatesParserMixin:
         return filter_fields
 
 
+class ConditionalGetMixin:
+    """
+    Adds ETag and Last-Modified headers to GET responses, responds 304 to conditional requests
+    for unchanged data. Validators are calculated after the authentication, before the response data
+    """
+    def get_etag_parts(self) -> tuple | None:
+        """
+        Get values which change together with the response data
+        :return: values or None if the response has no ETag
+
+        """
+        return None
+
+    def get_last_modified(self) -> datetime | None:
+        """
+        Get the time of the last response data change
+        :return: time or None if the response has no Last-Modified
+
+        """
+        return None
+
+    def get_etag(self) -> str | None:
+        parts = self.get_etag_parts()
+        if parts is None:
+            return None
+
+        # the same data is rendered differently for different renderers and pages
+        parts += (self.request.accepted_renderer.format, self.request.get_full_path())
+        return quote_etag(hashlib.sha256(repr(parts).encode()).hexdigest())
+
+    def get(self, request, *args, **kwargs):
+        etag = self.get_etag()
+        last_modified = self.get_last_modified()
+        last_modified = int(last_modified.timestamp()) if last_modified else None
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+
+        if etag and response.status_code in (200, 304):
+            response.headers['ETag'] = etag
+        if last_modified and response.status_code in (200, 304):
+            response.headers['Last-Modified'] = http_date(last_modified)
+        return response
+
+
+class ForecastViewMixin:
+    """
+    Serializes city weather forecasts within the time window of the query parameters from, to and hours_ahead.
+    Full forecasts are taken from the response cache, forecast windows are read from the database
+
+    """
+    def get_forecast_last_update(self) -> datetime | None:
+        # validators and the response use the same forecast version
+        if not hasattr(self, '_forecast_last_update'):
+            self._forecast_last_update = ForecastResponseCache.get_last_update()
+        return self._forecast_last_update
+
+    def get_forecast_version(self) -> str:
+        return ForecastResponseCache.get_version(self.get_forecast_last_update())
+
+    def get_forecast_window(self) -> dict[Literal['start', 'end', 'current_hour'], datetime | None]:
+        if not hasattr(self, '_forecast_window'):
+            window = serializers.ForecastWindowSerializer(data=self.request.query_params)
+            window.is_valid(raise_exception=True)
+            self._forecast_window = window.validated_data
+        return self._forecast_window
+
+    def get_forecast_last_modified(self, *updates: datetime | None) -> datetime | None:
+        # the window from the current hour moves without forecast updates
+        updates += (self.get_forecast_last_update(), self.get_forecast_window()['current_hour'])
+        return max(filter(None, updates), default=None)
+
+    def get_cities_data(self, cities) -> list[dict]:
+        window = self.get_forecast_window()
+        if window['start'] or window['end']:
+            return serializers.FastWeatherForecastSerializer().get_cities_data(cities, window['start'], window['end'])
+
+        return get_forecast_response_cache().get_cities_data(cities, self.get_forecast_version())
+
+
 class HomePageView(generic.ListView):
     template_name = 'weather_reminder/homepage.html'
 
@@ -61,7 +147,7 @@ class HomePageView(generic.ListView):
     def get_queryset(self):
         if self.request.user.is_anonymous:
             # return up to 3 random cities
-            return random.sample(list(models.City.objects.all()), min(models.City.objects.all().count(), 3))
+            return WeatherInterface.get_random_cities(3)
         else:
             return models.City.objects.filter(id__in=self.request.user.subscribed_cities.values('city')).all()\
                 .prefetch_related('weather_forecasts')
@@ -96,6 +182,15 @@ class APIRoot(rest_views.APIView):
                         'latitude': 0,
                         'longitude': 0},
                     request=request),
+                'Subscription alert rules': reverse(
+                    'weather_reminder:subscription_alerts',
+                    kwargs={
+                        'latitude': 0,
+                        'longitude': 0},
+                    request=request),
+                'Notification settings': reverse(
+                    'weather_reminder:notification_settings',
+                    request=request),
                 'Weather forecast for the city list': reverse(
                     'weather_reminder:forecasts_list',
                     request=request),
@@ -114,18 +209,23 @@ class APIRoot(rest_views.APIView):
             })
 
 
-class CityAPIView(rest_generics.ListAPIView):
+class CityAPIView(ConditionalGetMixin, rest_generics.ListAPIView):
     """
     Returns a list of all cities in the system.
     """
     queryset = models.City.objects.all()
     serializer_class = serializers.CitySerializer
+    pagination_class = CityCursorPagination
 
     def get_view_name(self):
         return 'City list'
 
+    def get_etag_parts(self) -> tuple:
+        # the cities update time is changed by every city save and deletion
+        return 'cities', models.LastUpdateTime.get_updated(models.LastUpdateTime.Key.CITIES)
 
-class SubscriptionsListAPIView(rest_mixins.CreateModelMixin, rest_generics.ListAPIView):
+
+class SubscriptionsListAPIView(ConditionalGetMixin, rest_mixins.CreateModelMixin, rest_generics.ListAPIView):
     """
     Returns subscriptions list for the user.
     User can add a new subscription.
@@ -140,6 +240,11 @@ class SubscriptionsListAPIView(rest_mixins.CreateModelMixin, rest_generics.ListA
     def get_view_name(self):
         return 'Subscriptions list'
 
+    def get_etag_parts(self) -> tuple:
+        subscriptions = self.request.user.subscribed_cities.order_by('pk')\
+            .values_list('pk', 'city', 'notification_frequency', 'alerts_only')
+        return 'subscriptions', self.request.user.pk, tuple(subscriptions)
+
     def post(self, request, *args, **kwargs):
         return self.create(request, *args, **kwargs)
 
@@ -186,9 +291,69 @@ class SubscriptionAPIView(CoordinatesParserMixin, rest_generics.RetrieveUpdateDe
         return obj
 
 
-class WeatherForecastListAPIView(rest_generics.ListAPIView):
+class SubscriptionAlertRulesAPIView(CoordinatesParserMixin, rest_generics.ListCreateAPIView):
+    """
+    Returns alert rules of the user subscription by the coordinates.
+    User can add a new rule: the forecast field (temperature, temperature_feels_like, pressure, humidity, pop,
+    cloudiness, wind_speed) compared with the threshold (gt, gte, lt, lte) within the next hours.
+
+    """
+    serializer_class = serializers.AlertRuleSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_view_name(self):
+        return 'Subscription alert rules'
+
+    def get_subscription(self) -> models.Subscription:
+        # find city by coordinates
+        city = WeatherInterface().get_city(**self.parse_coordinates())
+        return get_object_or_404(self.request.user.subscribed_cities.all(), city=city)
+
+    def get_queryset(self):
+        return self.get_subscription().alert_rules.all()
+
+    def perform_create(self, serializer):
+        serializer.save(subscription=self.get_subscription())
+
+
+class AlertRuleAPIView(rest_generics.RetrieveUpdateDestroyAPIView):
+    """
+    Returns the user alert rule.
+    User can modify or delete the rule.
+
+    """
+    serializer_class = serializers.AlertRuleSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_view_name(self):
+        return 'Alert rule'
+
+    def get_queryset(self):
+        return models.AlertRule.objects.filter(subscription__user=self.request.user)
+
+
+class NotificationSettingsAPIView(rest_generics.RetrieveUpdateAPIView):
+    """
+    Returns user notification settings.
+    User can choose the format of the forecast attached to emails: json, json.gz, columnar or csv.
+
+    """
+    serializer_class = serializers.NotificationSettingsSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_view_name(self):
+        return 'Notification settings'
+
+    def get_object(self):
+        obj, _ = models.NotificationSettings.objects.get_or_create(user=self.request.user)
+        return obj
+
+
+class WeatherForecastListAPIView(ForecastViewMixin, ConditionalGetMixin, rest_generics.ListAPIView):
     """
     Returns a list with the weather forecast for all user-subscribed cities.
+    Forecasts can be limited by the query parameters: from, to (forecast times, 'to' excluded)
+    and hours_ahead (hours from 'from' or from the start of the current hour).
 
     """
     serializer_class = serializers.CityWeatherForecast
@@ -196,16 +361,55 @@ class WeatherForecastListAPIView(rest_generics.ListAPIView):
 
     def get_queryset(self):
         user = self.request.user
-        return models.City.objects.filter(id__in=user.subscribed_cities.values('city')).all()\
-            .prefetch_related('weather_forecasts')
+        # forecasts are taken from the cache
+        return models.City.objects.filter(id__in=user.subscribed_cities.values('city')).all()
 
     def get_view_name(self):
         return 'Weather forecast for the city list'
 
+    def get_user_subscriptions_versions(self) -> tuple[tuple[int, datetime | None, datetime], ...]:
+        if not hasattr(self, '_subscriptions_versions'):
+            self._subscriptions_versions = tuple(
+                self.request.user.subscribed_cities.order_by('city')
+                .values_list('city', 'city__forecast_updated', 'updated')
+            )
+        return self._subscriptions_versions
 
-class CityWeatherForecastAPIView(CoordinatesParserMixin, rest_generics.RetrieveAPIView):
+    def get_etag_parts(self) -> tuple:
+        return (
+            'forecasts', self.request.user.pk, self.get_forecast_last_update(), self.get_user_subscriptions_versions(),
+            self.get_forecast_window()['current_hour']
+        )
+
+    def get_last_modified(self) -> datetime | None:
+        # deleted subscriptions leave no update time, the last deletion of any subscription is taken
+        subscription_deleted = models.LastUpdateTime.get_updated(models.LastUpdateTime.Key.SUBSCRIPTION_DELETION)
+        return self.get_forecast_last_modified(
+            subscription_deleted,
+            *(update for _, forecast_updated, updated in self.get_user_subscriptions_versions()
+              for update in (forecast_updated, updated)),
+        )
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.get_cities_data(page))
+
+        return Response(self.get_cities_data(queryset))
+
+
+class CityWeatherForecastAPIView(
+    ForecastViewMixin,
+    ConditionalGetMixin,
+    CoordinatesParserMixin,
+    rest_generics.RetrieveAPIView
+):
     """
     Returns a list with the weather forecast for the city.
+    Forecasts can be limited by the query parameters: from, to (forecast times, 'to' excluded)
+    and hours_ahead (hours from 'from' or from the start of the current hour).
 
     """
     serializer_class = serializers.CityWeatherForecast
@@ -214,7 +418,20 @@ class CityWeatherForecastAPIView(CoordinatesParserMixin, rest_generics.RetrieveA
         return 'Weather forecast for the city'
 
     def get_object(self):
-        # find city by coordinates
-        return WeatherInterface().get_city(**self.parse_coordinates())
+        # find city by coordinates, once for validators and the response
+        if not hasattr(self, '_city'):
+            self._city = WeatherInterface().get_city(**self.parse_coordinates())
+        return self._city
+
+    def get_etag_parts(self) -> tuple:
+        city = self.get_object()
+        return (
+            'forecast', city.pk, self.get_forecast_last_update(), city.forecast_updated,
+            self.get_forecast_window()['current_hour']
+        )
 
+    def get_last_modified(self) -> datetime | None:
+        return self.get_forecast_last_modified(self.get_object().forecast_updated)
 
+    def retrieve(self, request, *args, **kwargs):
+        return Response(self.get_cities_data([self.get_object()])[0])